@@ -1,17 +1,22 @@
 import os
 from openai import OpenAI
 
-def deepseek_chat(prompt):
+try:
+    from response_cache import cached_completion
+except ImportError:  # response_cache.py lives in src/; without it on the path, responses are not cached
+    def cached_completion(create, request, bypass=False):
+        return create(**request).choices[0].message.content
+
+def deepseek_chat(prompt, bypass_cache=False):
     client = OpenAI(
         api_key=os.getenv("DEEPSEEK_API_KEY"),
         base_url="https://api.deepseek.com"      
     )
-    response = client.chat.completions.create(
+    return cached_completion(client.chat.completions.create, dict(
         model="deepseek-chat",  # **Model Name**
         messages=[
             {"role": "system", "content": "You are a helpful assistant"},
             {"role": "user", "content": prompt},
         ],
         stream=False
-    )
-    return response.choices[0].message.content
+    ), bypass_cache)
@@ -1,13 +1,19 @@
 from google import genai
 import os 
+
+try:
+    from response_cache import cached_completion
+except ImportError:  # response_cache.py lives in src/; without it on the path, responses are not cached
+    def cached_completion(create, request, bypass=False):
+        return create(**request).text
+
 client = genai.Client(api_key=os.getenv("GEMINI_API_KEY") )
 
-def gemini_api(prompt):
-    response = client.models.generate_content(
+def gemini_api(prompt, bypass_cache=False):
+    return cached_completion(client.models.generate_content, dict(
         model="gemini-2.0-flash",
         contents=prompt
-    )
-    return response.text
+    ), bypass_cache)
 
 if __name__ == "__main__":
     print(gemini_api("What date is it today?"))
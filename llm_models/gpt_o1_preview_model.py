@@ -1,17 +1,22 @@
 from openai import OpenAI
 
+try:
+    from response_cache import cached_completion
+except ImportError:  # response_cache.py lives in src/; without it on the path, responses are not cached
+    def cached_completion(create, request, bypass=False):
+        return create(**request).choices[0].message.content
+
 client = OpenAI()
 
-def chatGPT_api(message_content):
-    response = client.chat.completions.create(
+def chatGPT_api(message_content, bypass_cache=False):
+    return cached_completion(client.chat.completions.create, dict(
         model = "o1-preview",
         response_format={'type':'json_object'},
         messages = [
             {"role" : "user", "content" : "Provide output in valid JSON."},
             {"role": "user", "content": message_content}
         ]
-    )
-    return response.choices[0].message.content
+    ), bypass_cache)
 
-def gpt_o1_preview(prompt):
-    return chatGPT_api(prompt)
\ No newline at end of file
+def gpt_o1_preview(prompt, bypass_cache=False):
+    return chatGPT_api(prompt, bypass_cache)
\ No newline at end of file
@@ -0,0 +1,89 @@
+import asyncio
+import random
+
+class AIMDLimiter:
+    """
+    Adaptive concurrency limit for one kind of asyncio API call.
+
+    The limit follows additive increase / multiplicative decrease: every success made while the
+    limit was fully used raises it by increase / limit (about +increase per full window of
+    calls), and every congestion signal (an exception in retry_on, e.g. a 429 or a timeout)
+    multiplies it by decrease. Calls that were already in flight when the limit was cut do not
+    cut it again, so a burst of failures counts as one congestion event. Congested calls are
+    retried after an exponential backoff with jitter, up to retries times.
+    """
+    def __init__(self, name, initial=4, minimum=1, maximum=64, increase=1.0, decrease=0.5,
+                 retry_on=(asyncio.TimeoutError,), retries=6, max_backoff=60.0):
+        self.name = name
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.retry_on = tuple(retry_on)
+        self.retries = retries
+        self.max_backoff = max_backoff
+        self.in_flight = 0
+        self.generation = 0
+        self.condition = None
+        self.successes = 0
+        self.congestion_events = 0
+        self.decreases = 0
+        self.peak_limit = self.limit
+
+    async def acquire(self):
+        """Wait for a free slot under the current limit; returns the generation of the limit."""
+        if self.condition is None:
+            self.condition = asyncio.Condition()
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < max(self.minimum, int(self.limit)))
+            self.in_flight += 1
+            return self.generation
+
+    async def release(self, generation, outcome):
+        """Free a slot and adjust the limit; outcome is "success", "congestion" or "error"."""
+        async with self.condition:
+            saturated = self.in_flight >= int(self.limit)
+            self.in_flight -= 1
+            if outcome == "success":
+                self.successes += 1
+                # Only grow a limit that is actually the bottleneck.
+                if saturated:
+                    self.limit = min(self.maximum, self.limit + self.increase / self.limit)
+                self.peak_limit = max(self.peak_limit, self.limit)
+            elif outcome == "congestion":
+                self.congestion_events += 1
+                if generation == self.generation:
+                    self.limit = max(self.minimum, self.limit * self.decrease)
+                    self.generation += 1
+                    self.decreases += 1
+            self.condition.notify_all()
+
+    async def call(self, func, *args, **kwargs):
+        """Await func(*args, **kwargs) within the limit, retrying congestion errors."""
+        for attempt in range(self.retries + 1):
+            generation = await self.acquire()
+            try:
+                result = await func(*args, **kwargs)
+            except self.retry_on:
+                await self.release(generation, "congestion")
+                if attempt == self.retries:
+                    raise
+                backoff = min(self.max_backoff, 2 ** attempt)
+                await asyncio.sleep(backoff * (0.5 + random.random() / 2))
+                continue
+            except BaseException:
+                await self.release(generation, "error")
+                raise
+            await self.release(generation, "success")
+            return result
+
+    def stats(self):
+        return {
+            "name": self.name,
+            "limit": round(self.limit, 2),
+            "peak_limit": round(self.peak_limit, 2),
+            "successes": self.successes,
+            "congestion_events": self.congestion_events,
+            "decreases": self.decreases
+        }
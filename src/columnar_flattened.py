@@ -0,0 +1,99 @@
+import json
+import os
+
+import numpy as np
+import pyarrow as pa
+
+from columnar_io import write_columnar_table, read_columnar_table
+
+# Flattened records are stored in long form, one row per (record, key path) leaf. Key paths
+# and values are interned into Arrow dictionaries, so a path like "a.b[3].c" is stored once per
+# file instead of once per record. Values are kept as JSON text so every leaf type (strings,
+# numbers, booleans, None, empty containers) round-trips exactly.
+# A record with no leaves is stored as a single row with a null key so it is not lost.
+FLATTENED_SCHEMA = pa.schema([
+    ("record", pa.int32()),
+    ("key", pa.dictionary(pa.int32(), pa.string())),
+    ("value", pa.dictionary(pa.int32(), pa.string()))
+])
+
+FLATTENED_COLUMNAR_FILENAMES = {
+    "parquet": "flattened_structured_data.parquet",
+    "arrow": "flattened_structured_data.arrow"
+}
+
+##############################
+# Building Columnar Tables
+##############################
+
+def intern(values, dictionary):
+    """Return the index of each value in dictionary (value -> index), adding unseen values."""
+    return [dictionary.setdefault(value, len(dictionary)) for value in values]
+
+def flattened_records_to_arrow(records):
+    """Convert flattened records (dicts of key path -> leaf value) into a dictionary-encoded Arrow table."""
+    record_indices = []
+    key_indices = []
+    value_indices = []
+    keys = {}
+    values = {}
+    for index, record in enumerate(records):
+        if not record:
+            record_indices.append(index)
+            key_indices.append(None)
+            value_indices.append(None)
+            continue
+        record_indices.extend([index] * len(record))
+        key_indices.extend(intern(record, keys))
+        value_indices.extend(intern([json.dumps(value) for value in record.values()], values))
+    return pa.Table.from_arrays([
+        pa.array(record_indices, pa.int32()),
+        pa.DictionaryArray.from_arrays(pa.array(key_indices, pa.int32()), pa.array(list(keys), pa.string())),
+        pa.DictionaryArray.from_arrays(pa.array(value_indices, pa.int32()), pa.array(list(values), pa.string()))
+    ], schema=FLATTENED_SCHEMA)
+
+def arrow_to_flattened_records(table):
+    """Rebuild the list of flattened records from a table made by flattened_records_to_arrow."""
+    record_column = table.column("record").to_numpy()
+    keys = table.column("key").to_pylist()
+    values = table.column("value").to_pylist()
+    num_records = int(record_column.max()) + 1 if len(record_column) else 0
+    records = [{} for _ in range(num_records)]
+    for index, key, value in zip(record_column.tolist(), keys, values):
+        if key is not None:
+            records[index][key] = json.loads(value)
+    return records
+
+##############################
+# Reading and Writing
+##############################
+
+def write_flattened_columnar(records, output_path):
+    """Write flattened records to a ".parquet" or ".arrow" file (see write_columnar_table)."""
+    write_columnar_table(flattened_records_to_arrow(records), output_path)
+
+def read_flattened_columnar(path):
+    """Load the flattened records stored in a file written by write_flattened_columnar."""
+    return arrow_to_flattened_records(read_columnar_table(path))
+
+def load_flattened_corpus(output_flattened_dir, extension=".parquet"):
+    """
+    Load every columnar flattened file under output_flattened_dir into one Arrow table for
+    corpus-wide analytics, with a dictionary-encoded "doc_key" column naming each row's
+    per-document output directory (relative to output_flattened_dir).
+    """
+    tables = []
+    for root, _, files in os.walk(output_flattened_dir):
+        for file in files:
+            if file.endswith(extension):
+                table = read_columnar_table(os.path.join(root, file))
+                doc_key = os.path.relpath(root, output_flattened_dir)
+                doc_keys = pa.DictionaryArray.from_arrays(
+                    pa.array(np.zeros(len(table), dtype=np.int32)), pa.array([doc_key])
+                )
+                tables.append(table.append_column("doc_key", doc_keys))
+    if not tables:
+        return FLATTENED_SCHEMA.empty_table().append_column(
+            "doc_key", pa.array([], pa.dictionary(pa.int32(), pa.string()))
+        )
+    return pa.concat_tables(tables).unify_dictionaries()
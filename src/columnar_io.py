@@ -0,0 +1,28 @@
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Shared file IO for the columnar modules; it only needs pyarrow, so columnar_flattened can be
+# used without the geometry dependencies that columnar_standardized pulls in.
+
+def write_columnar_table(table, output_path):
+    """
+    Write an Arrow table.
+    ".arrow" writes an uncompressed Arrow IPC file that can be memory-mapped without copying;
+    ".parquet" writes a compressed Parquet file for cold storage.
+    """
+    if output_path.endswith(".parquet"):
+        pq.write_table(table, output_path)
+    elif output_path.endswith(".arrow"):
+        with pa.OSFile(output_path, "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+    else:
+        raise ValueError(f"Unsupported columnar file extension: {output_path}")
+
+def read_columnar_table(path):
+    """Memory-map a table written by write_columnar_table."""
+    if path.endswith(".parquet"):
+        return pq.read_table(path, memory_map=True)
+    if path.endswith(".arrow"):
+        return pa.ipc.open_file(pa.memory_map(path, "r")).read_all()
+    raise ValueError(f"Unsupported columnar file extension: {path}")
@@ -0,0 +1,217 @@
+import os
+import json
+from collections.abc import Mapping
+
+import numpy as np
+import pyarrow as pa
+
+from columnar_io import write_columnar_table as write_standardized, read_columnar_table as read_standardized
+from structured_extraction_v2 import (
+    load_and_standardize_tables,
+    load_and_standardize_kv,
+    load_and_standardize_lines,
+    iter_combined_pages,
+    iter_json_files,
+    write_combined_json,
+    build_manifest,
+    manifest_path_for
+)
+
+# Standardized bboxes are 4 (x, y) points, stored as 8 float64 values [x0, y0, x1, y1, ...].
+# Bboxes with any other number of points leave "bbox" null and go to "bbox_points" instead.
+BBOX_POINTS = 4
+BBOX_WIDTH = BBOX_POINTS * 2
+
+STANDARDIZED_SCHEMA = pa.schema([
+    ("page_no", pa.int32()),
+    ("type", pa.dictionary(pa.int8(), pa.string())),
+    ("content", pa.string()),
+    ("bbox", pa.list_(pa.float64(), BBOX_WIDTH)),
+    ("bbox_points", pa.list_(pa.float64()))
+])
+
+##############################
+# Building Columnar Tables
+##############################
+
+def standardized_items_to_arrow(items, item_type):
+    """
+    Convert standardized items (dicts from standardize_*_item) into an Arrow table.
+    Pages that are not integers become null, matching group_by_page which drops them.
+    Coordinates are stored as float64.
+    """
+    pages = []
+    contents = []
+    bboxes = []
+    irregular = []
+    for item in items:
+        page = item.get("page_no")
+        try:
+            pages.append(int(page))
+        except Exception:
+            pages.append(None)
+        contents.append(item.get("content", ""))
+        flat = [coord for pt in item["bbox"] for coord in pt]
+        if len(flat) == BBOX_WIDTH:
+            bboxes.append(flat)
+            irregular.append(None)
+        else:
+            bboxes.append(None)
+            irregular.append(flat)
+    types = pa.DictionaryArray.from_arrays(
+        pa.array(np.zeros(len(items), dtype=np.int8)), pa.array([item_type])
+    )
+    return pa.Table.from_arrays([
+        pa.array(pages, pa.int32()),
+        types,
+        pa.array(contents, pa.string()),
+        pa.array(bboxes, pa.list_(pa.float64(), BBOX_WIDTH)),
+        pa.array(irregular, pa.list_(pa.float64()))
+    ], schema=STANDARDIZED_SCHEMA)
+
+def load_standardized_arrow(table_file_path, kv_file_path, lines_file_path):
+    """Load and standardize the three Document Intelligence JSON files into one Arrow table."""
+    return pa.concat_tables([
+        standardized_items_to_arrow(load_and_standardize_tables(table_file_path), "table"),
+        standardized_items_to_arrow(load_and_standardize_kv(kv_file_path), "kv_pair"),
+        standardized_items_to_arrow(load_and_standardize_lines(lines_file_path), "line")
+    ]).unify_dictionaries()
+
+##############################
+# Grouping and Combining
+##############################
+
+class ColumnarPageGroups(Mapping):
+    """
+    Read-only mapping of page number -> standardized items of one type, backed by an Arrow table.
+
+    Rows are grouped by page with a single stable sort of the page column, kept as an index
+    array over the (memory-mapped) table. Only the rows of a page are read when it is looked
+    up: a zero-copy slice when they are contiguous, as in files written page by page, and a
+    take of just those rows otherwise. Python dicts are only built for the page being looked
+    up, so a whole document never has to be materialized at once. Iteration is in ascending
+    page order.
+    """
+    def __init__(self, table, item_type):
+        self.item_type = item_type
+        self.table = table
+        types = table.column("type").combine_chunks().dictionary_decode()
+        rows = np.flatnonzero(types.to_numpy(zero_copy_only=False) == item_type)
+        pages = table.column("page_no").take(rows).to_numpy(zero_copy_only=False).astype(np.float64)
+        valid = np.flatnonzero(~np.isnan(pages))
+        order = valid[np.argsort(pages[valid], kind="stable")]
+        self.rows = rows[order]
+        self.pages, starts = np.unique(pages[order].astype(np.int64), return_index=True)
+        self.bounds = dict(zip(self.pages.tolist(), zip(starts.tolist(), starts[1:].tolist() + [len(order)])))
+
+    def page_rows(self, page):
+        """Return the rows of one page as a table, without copying them when they are contiguous."""
+        start, stop = self.bounds[page]
+        indices = self.rows[start:stop]
+        if indices[-1] - indices[0] == len(indices) - 1:
+            return self.table.slice(int(indices[0]), len(indices))
+        return self.table.take(indices)
+
+    def __getitem__(self, page):
+        rows = self.page_rows(page)
+        contents = rows.column("content").to_pylist()
+        bbox_column = rows.column("bbox").combine_chunks()
+        # flatten() skips null bboxes, so regular coordinates are consumed in order.
+        coords = bbox_column.flatten().to_numpy(zero_copy_only=False).reshape(-1, BBOX_POINTS, 2).tolist()
+        has_regular_bbox = bbox_column.is_valid().to_numpy(zero_copy_only=False)
+        irregular = rows.column("bbox_points").to_pylist()
+        items = []
+        regular = 0
+        for i, content in enumerate(contents):
+            if has_regular_bbox[i]:
+                bbox = [tuple(pt) for pt in coords[regular]]
+                regular += 1
+            else:
+                flat = irregular[i]
+                bbox = list(zip(flat[0::2], flat[1::2]))
+            item = {"page_no": page, "type": self.item_type, "bbox": bbox, "content": content}
+            if self.item_type == "line":
+                del item["type"]
+            items.append(item)
+        return items
+
+    def __iter__(self):
+        return iter(self.bounds)
+
+    def __len__(self):
+        return len(self.bounds)
+
+def iter_combine_columnar(table):
+    """Yield (page, combined_items) for a standardized Arrow table, one page at a time."""
+    tables_by_page = ColumnarPageGroups(table, "table")
+    kv_by_page = ColumnarPageGroups(table, "kv_pair")
+    lines_by_page = ColumnarPageGroups(table, "line")
+    yield from iter_combined_pages(tables_by_page, kv_by_page, lines_by_page.items())
+
+def combine_columnar_file(path):
+    """Combine a standardized columnar file. Returns a dictionary keyed by page number."""
+    return dict(iter_combine_columnar(read_standardized(path)))
+
+###################################
+# Multi-File Processing Functions
+###################################
+
+def convert_structured_extraction_directories(table_dir, kv_pair_dir, lines_dir, columnar_dir, extension=".arrow"):
+    """
+    Standardize every document once and store it as a columnar file under columnar_dir,
+    mirroring the layout of table_dir. Later runs can memory-map these instead of re-parsing JSON.
+    Returns the list of written paths.
+    """
+    written = []
+    for sub_dir, file in iter_json_files(table_dir):
+        table = load_standardized_arrow(os.path.join(table_dir, sub_dir, file),
+                                        os.path.join(kv_pair_dir, sub_dir, file),
+                                        os.path.join(lines_dir, sub_dir, file))
+        output_path = os.path.join(columnar_dir, sub_dir, os.path.splitext(file)[0] + extension)
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        write_standardized(table, output_path)
+        written.append(output_path)
+    return written
+
+def combine_columnar_directory(columnar_dir, output_extraction_dir, compact=False):
+    """
+    Combine every columnar file under columnar_dir into combined_structured_data.json outputs.
+    As in structured_extraction_v2.process_single_file, each output is written to a temporary
+    file first and saved with a manifest. The manifest records the columnar file as the only
+    input (and "source": "columnar"), so incremental runs of structured_extraction_v2 never
+    mistake this output (whose coordinates are floats) for one combined from the JSON inputs.
+    """
+    for root, _, files in os.walk(columnar_dir):
+        sub_dir = os.path.relpath(root, columnar_dir)
+        for file in files:
+            if file.endswith((".arrow", ".parquet")):
+                input_path = os.path.join(root, file)
+                output_subdir = os.path.join(output_extraction_dir, sub_dir, os.path.splitext(file)[0])
+                os.makedirs(output_subdir, exist_ok=True)
+                output_path = os.path.join(output_subdir, "combined_structured_data.json")
+                # Take the manifest before reading, so an input modified mid-run is picked up next time.
+                manifest = build_manifest({"columnar": input_path})
+                manifest["source"] = "columnar"
+                partial_path = output_path + ".partial"
+                write_combined_json(iter_combine_columnar(read_standardized(input_path)), partial_path, compact)
+                os.replace(partial_path, output_path)
+                with open(manifest_path_for(output_path), "w") as f:
+                    json.dump(manifest, f, indent=4)
+                print(f"Processed file. Output saved to {output_path}")
+
+###################################
+# Main Entry Point
+###################################
+
+if __name__ == "__main__":
+    document_intelligence_tables_dir = "../tst/document_intelligence_tables"
+    document_intelligence_kv_pairs_dir = "../tst/document_intelligence_kv_pairs"
+    document_intelligence_lines_dir = "../tst/document_intelligence_lines"
+    columnar_dir = "../tst/document_intelligence_columnar"
+    output_extraction_dir = "../tst/pipeline_results_v2"
+
+    convert_structured_extraction_directories(document_intelligence_tables_dir,
+                                              document_intelligence_kv_pairs_dir,
+                                              document_intelligence_lines_dir,
+                                              columnar_dir)
+    combine_columnar_directory(columnar_dir, output_extraction_dir)
@@ -0,0 +1,342 @@
+import os
+import json
+import random
+import tempfile
+import time
+import tracemalloc
+
+import structured_extraction_v2
+from structured_extraction_v2 import (is_within, get_top, get_bottom, find_contained_items,
+                                      assign_k_lines, JoinedTexts, iter_combine_json_files)
+
+############################
+# Synthetic Page Generators
+############################
+
+def make_box(x, y, width, height):
+    """Return a standardized 4-point bbox (list of (x, y) tuples) for an axis-aligned rectangle."""
+    return [(x, y), (x + width, y), (x + width, y + height), (x, y + height)]
+
+WORDS = ["case", "number", "officer", "badge", "incident", "date", "report", "unit",
+         "complaint", "suspect", "witness", "address", "vehicle", "narrative", "supervisor"]
+
+def make_text(rng, length):
+    """Return random words from WORDS joined by spaces, about length characters long."""
+    words = []
+    size = -1
+    while size < length:
+        word = rng.choice(WORDS)
+        words.append(word)
+        size += len(word) + 1
+    return " ".join(words)
+
+def make_synthetic_page(num_kv, num_tables, num_lines, page_no=1, seed=0, text_length=None):
+    """
+    Build one standardized page (tables, kv_pairs, lines) with random layout.
+    Roughly a third of the kv pairs are placed inside a table so that both
+    branches of the containment filter are exercised.
+    With text_length set, contents are random words of about that many characters
+    instead of short labels.
+    """
+    rng = random.Random(seed)
+    page_width, page_height = 612.0, 792.0
+    tables = []
+    for t in range(num_tables):
+        x, y = rng.uniform(0, page_width / 2), rng.uniform(0, page_height - 150)
+        tables.append({
+            "page_no": page_no,
+            "type": "table",
+            "bbox": make_box(x, y, rng.uniform(150, 300), rng.uniform(60, 150)),
+            "content": make_text(rng, text_length) if text_length else f"table {t}"
+        })
+    kv_pairs = []
+    for k in range(num_kv):
+        if tables and rng.random() < 0.33:
+            (tx0, ty0), (tx1, _), (_, ty1) = tables[rng.randrange(len(tables))]["bbox"][:3]
+            x, y = rng.uniform(tx0, tx1 - 20), rng.uniform(ty0, ty1 - 8)
+            bbox = make_box(x, y, min(20.0, tx1 - x), min(8.0, ty1 - y))
+        else:
+            bbox = make_box(rng.uniform(0, page_width - 80), rng.uniform(0, page_height - 12), 80, 12)
+        kv_pairs.append({
+            "page_no": page_no,
+            "type": "kv_pair",
+            "bbox": bbox,
+            "content": make_text(rng, text_length) if text_length else f"key {k} value {k}"
+        })
+    lines = []
+    for n in range(num_lines):
+        lines.append({
+            "page_no": page_no,
+            "bbox": make_box(rng.uniform(0, page_width - 200), rng.uniform(0, page_height - 10), 200, 10),
+            "content": make_text(rng, 40) if text_length else f"line {n}"
+        })
+    return tables, kv_pairs, lines
+
+def to_document_intelligence_box(bbox):
+    """Convert a standardized bbox back to the Document Intelligence "point.x"/"point.y" form."""
+    return {"point.x": [pt[0] for pt in bbox], "point.y": [pt[1] for pt in bbox]}
+
+def make_document_intelligence_files(output_dir, num_pages, kv_per_page=100, tables_per_page=2,
+                                     lines_per_page=200, text_length=40, seed=0):
+    """
+    Write synthetic tables.json, kv_pairs.json and lines.json files shaped like the
+    Document Intelligence outputs that structured_extraction_v2 reads.
+    Tables get 4 columns and enough rows for about text_length characters per cell row;
+    a fifth of the lines repeat a kv key so the k-line filter has work to do.
+    Returns the (tables, kv_pairs, lines) paths.
+    """
+    rng = random.Random(seed)
+    tables, kv_pairs, line_pages = [], [], []
+    for page in range(1, num_pages + 1):
+        page_tables, page_kv, page_lines = make_synthetic_page(kv_per_page, tables_per_page, lines_per_page,
+                                                               page_no=page, seed=seed * 100003 + page)
+        for table in page_tables:
+            rows = max(1, text_length // 20)
+            tables.append({
+                "page_no": page,
+                "table_bounding_region": to_document_intelligence_box(table["bbox"]),
+                "cells": [
+                    {"rowIndex": r, "columnIndex": c, "content": make_text(rng, text_length // 4)}
+                    for r in range(rows) for c in range(4)
+                ]
+            })
+        for kv in page_kv:
+            key = make_text(rng, max(1, text_length // 3))
+            kv_pairs.append({
+                "page_number": page,
+                "key": key,
+                "value": make_text(rng, text_length - len(key)),
+                "key_bounding_box": to_document_intelligence_box(kv["bbox"]),
+                "value_bounding_box": to_document_intelligence_box(kv["bbox"])
+            })
+        content = []
+        for line in page_lines:
+            if kv_pairs and rng.random() < 0.2:
+                text = rng.choice(kv_pairs)["key"]
+            else:
+                text = make_text(rng, 40)
+            content.append({"text": text, "bbox": to_document_intelligence_box(line["bbox"])})
+        line_pages.append({"page_no": page, "content": content})
+    paths = tuple(os.path.join(output_dir, name) for name in ("tables.json", "kv_pairs.json", "lines.json"))
+    for path, data in zip(paths, ({"tables": tables}, kv_pairs, line_pages)):
+        with open(path, "w") as f:
+            json.dump(data, f)
+    return paths
+
+##############################
+# Reference Implementations
+##############################
+
+def legacy_find_contained_items(inner_items, outer_items):
+    """Pairwise is_within loop that find_contained_items replaced; kept as the reference result."""
+    contained = []
+    for inner in inner_items:
+        contained.append(any(is_within(inner['bbox'], outer['bbox']) for outer in outer_items))
+    return contained
+
+def legacy_assign_k_lines(combined_data, page_lines):
+    """Remaining-lines rebuild loop that assign_k_lines replaced; kept as the reference result."""
+    remaining_lines = page_lines.copy()
+    assigned = []
+    for data in combined_data:
+        region_top = get_top(data['bbox'])
+        context_lines = []
+        new_remaining = []
+        for line in remaining_lines:
+            if get_bottom(line['bbox']) < region_top:
+                context_lines.append(line['content'].strip())
+            else:
+                new_remaining.append(line)
+        remaining_lines = new_remaining
+        assigned.append(context_lines)
+    return assigned
+
+def legacy_filter_k_lines(context_lines, structured_texts):
+    """Per-line scan over every structured text that JoinedTexts replaced; kept as the reference result."""
+    return [
+        line for line in context_lines
+        if not any(line and (line in s) for s in structured_texts)
+    ]
+
+def joined_filter_k_lines(context_lines, structured_texts):
+    """Same filter as legacy_filter_k_lines, answered by JoinedTexts."""
+    joined = JoinedTexts(structured_texts)
+    return [line for line in context_lines if not (line and line in joined)]
+
+def make_synthetic_texts(num_texts, num_lines, text_length, seed=0):
+    """
+    Return (structured_texts, context_lines) drawn from a small alphabet so that many
+    lines are genuine substrings of the texts and many others narrowly miss.
+    """
+    rng = random.Random(seed)
+    words = ["case", "no", "officer", "date", "unit", "badge", "report", "\t", "\n", "1", "2"]
+    texts = []
+    for _ in range(num_texts):
+        text = ""
+        while len(text) < text_length:
+            text += rng.choice(words) + " "
+        texts.append(text.strip())
+    lines = []
+    for _ in range(num_lines):
+        if texts and rng.random() < 0.5:
+            text = rng.choice(texts)
+            start = rng.randrange(len(text))
+            lines.append(text[start:start + rng.randint(0, 40)].strip())
+        else:
+            lines.append(" ".join(rng.choice(words) for _ in range(rng.randint(1, 6))).strip())
+    return texts, lines
+
+def snap_to_grid(items, step=10.0):
+    """Round every bbox coordinate to a multiple of step so that tops and bottoms tie often."""
+    for item in items:
+        item['bbox'] = [(round(x / step) * step, round(y / step) * step) for x, y in item['bbox']]
+    return items
+
+##############################
+# Differential Checks
+##############################
+
+def check_k_lines(num_seeds=50):
+    """Compare assign_k_lines with the reference loop on random pages, including tied coordinates."""
+    for seed in range(num_seeds):
+        tables, kv_pairs, lines = make_synthetic_page(40, 3, 120, seed=seed)
+        if seed % 2:
+            snap_to_grid(tables + kv_pairs + lines)
+        combined_data = sorted(tables + kv_pairs, key=lambda item: get_top(item['bbox']))
+        expected = legacy_assign_k_lines(combined_data, lines)
+        actual = assign_k_lines(combined_data, lines)
+        assert actual == expected, f"assign_k_lines disagrees with the reference loop (seed={seed})"
+    print(f"k-lines: assign_k_lines matches the reference loop on {num_seeds} pages")
+
+def check_k_line_filter(num_seeds=50):
+    """Compare the JoinedTexts filter with the reference scan on random texts and lines."""
+    for seed in range(num_seeds):
+        texts, lines = make_synthetic_texts(seed % 6, 200, 300, seed=seed)
+        expected = legacy_filter_k_lines(lines, texts)
+        actual = joined_filter_k_lines(lines, texts)
+        assert actual == expected, f"JoinedTexts filter disagrees with the reference scan (seed={seed})"
+    print(f"k-line filter: JoinedTexts matches the reference scan on {num_seeds} pages")
+
+##############################
+# Benchmarks
+##############################
+
+def time_call(func, *args, repeat=3):
+    """Return (best wall time in seconds, result of the last call)."""
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def benchmark_containment(num_kv=1000, num_tables=8, seed=0):
+    """Compare the pairwise containment loop with find_contained_items on one synthetic page."""
+    tables, kv_pairs, _ = make_synthetic_page(num_kv, num_tables, 0, seed=seed)
+    legacy_time, legacy_result = time_call(legacy_find_contained_items, kv_pairs, tables)
+    new_time, new_result = time_call(find_contained_items, kv_pairs, tables)
+    assert legacy_result == new_result, "find_contained_items disagrees with the pairwise loop"
+    print(f"containment: {num_kv} kv pairs x {num_tables} tables "
+          f"({sum(new_result)} contained)")
+    print(f"  pairwise is_within:   {legacy_time * 1000:8.2f} ms")
+    print(f"  find_contained_items: {new_time * 1000:8.2f} ms  ({legacy_time / new_time:.1f}x)")
+
+def benchmark_k_lines(num_items=1000, num_lines=2000, seed=0):
+    """Compare the remaining-lines rebuild loop with assign_k_lines on one synthetic page."""
+    tables, kv_pairs, lines = make_synthetic_page(num_items, 0, num_lines, seed=seed)
+    combined_data = sorted(tables + kv_pairs, key=lambda item: get_top(item['bbox']))
+    legacy_time, legacy_result = time_call(legacy_assign_k_lines, combined_data, lines)
+    new_time, new_result = time_call(assign_k_lines, combined_data, lines)
+    assert legacy_result == new_result, "assign_k_lines disagrees with the reference loop"
+    print(f"k-lines: {num_items} items x {num_lines} lines")
+    print(f"  remaining-lines loop: {legacy_time * 1000:8.2f} ms")
+    print(f"  assign_k_lines:       {new_time * 1000:8.2f} ms  ({legacy_time / new_time:.1f}x)")
+
+def benchmark_k_line_filter(num_texts=200, num_lines=20000, text_length=2000, seed=0):
+    """Compare the per-line scan with the JoinedTexts filter on long table-like texts."""
+    texts, lines = make_synthetic_texts(num_texts, num_lines, text_length, seed=seed)
+    legacy_time, legacy_result = time_call(legacy_filter_k_lines, lines, texts)
+    new_time, new_result = time_call(joined_filter_k_lines, lines, texts)
+    assert legacy_result == new_result, "JoinedTexts filter disagrees with the reference scan"
+    print(f"k-line filter: {num_lines} lines x {num_texts} texts of {text_length} chars")
+    print(f"  per-line scan:        {legacy_time * 1000:8.2f} ms")
+    print(f"  JoinedTexts:          {new_time * 1000:8.2f} ms  ({legacy_time / new_time:.1f}x)")
+
+##############################
+# Combine Stage Benchmarks
+##############################
+
+def consume_combined_pages(paths, streaming=False):
+    """Combine a document page by page, as process_single_file does, discarding each page. Returns the page count."""
+    return sum(1 for _ in iter_combine_json_files(*paths, streaming=streaming))
+
+def measure_combine_stage(paths, streaming=False):
+    """
+    Run the combine stage on one document twice: once for wall time and once under
+    tracemalloc for peak Python heap usage. Returns (seconds, peak_bytes, num_pages).
+    """
+    start = time.perf_counter()
+    num_pages = consume_combined_pages(paths, streaming)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    consume_combined_pages(paths, streaming)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak, num_pages
+
+def benchmark_combine_stage(num_pages=10, kv_per_page=100, tables_per_page=2, lines_per_page=200,
+                            text_length=40, streaming=False, seed=0):
+    """Generate one synthetic document with the given shape and measure the combine stage on it."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = make_document_intelligence_files(tmp_dir, num_pages, kv_per_page, tables_per_page,
+                                                 lines_per_page, text_length, seed)
+        input_bytes = sum(os.path.getsize(path) for path in paths)
+        elapsed, peak, pages = measure_combine_stage(paths, streaming)
+    return {
+        "num_pages": num_pages,
+        "kv_per_page": kv_per_page,
+        "tables_per_page": tables_per_page,
+        "lines_per_page": lines_per_page,
+        "text_length": text_length,
+        "streaming": streaming,
+        "input_mib": input_bytes / 2**20,
+        "seconds": elapsed,
+        "ms_per_page": elapsed * 1000 / max(pages, 1),
+        "peak_mib": peak / 2**20
+    }
+
+def benchmark_scaling(parameter, values, **config):
+    """
+    Print a scaling curve: run benchmark_combine_stage once per value of parameter,
+    keeping the rest of config fixed. Returns the list of result dicts.
+    """
+    fixed = ", ".join(f"{k}={v}" for k, v in config.items())
+    print(f"combine stage scaling over {parameter}" + (f" ({fixed})" if fixed else ""))
+    print(f"  {parameter:>16} {'input MiB':>10} {'total s':>9} {'ms/page':>9} {'peak MiB':>9}")
+    results = []
+    for value in values:
+        result = benchmark_combine_stage(**{**config, parameter: value})
+        results.append(result)
+        print(f"  {str(value):>16} {result['input_mib']:10.2f} {result['seconds']:9.3f} "
+              f"{result['ms_per_page']:9.2f} {result['peak_mib']:9.2f}")
+    return results
+
+###################################
+# Main Entry Point
+###################################
+
+if __name__ == "__main__":
+    for num_tables in (1, 8, 32):
+        benchmark_containment(num_kv=1000, num_tables=num_tables)
+    check_k_lines()
+    benchmark_k_lines()
+    check_k_line_filter()
+    benchmark_k_line_filter(num_texts=50, num_lines=2000, text_length=500)
+    benchmark_k_line_filter(num_texts=200, num_lines=20000, text_length=2000)
+    benchmark_scaling("num_pages", [1, 10, 50, 200])
+    benchmark_scaling("kv_per_page", [10, 100, 500], num_pages=10)
+    benchmark_scaling("lines_per_page", [50, 200, 1000], num_pages=10)
+    benchmark_scaling("text_length", [20, 200, 1000], num_pages=10)
+    if structured_extraction_v2.ijson is not None:
+        benchmark_scaling("streaming", [False, True], num_pages=200)
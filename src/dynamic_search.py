@@ -1,34 +1,97 @@
 import os
 import json
 import csv
+import asyncio
 import numpy as np
 import faiss
-from openai import OpenAI
+import openai
+from openai import OpenAI, AsyncOpenAI
 import io
+import threading
 import traceback
+from functools import lru_cache
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
+import result_store
+from aimd_limiter import AIMDLimiter
+from embedding_backends import (
+    EmbeddingBackend,
+    OpenAIEmbeddingBackend,
+    get_embedding_backend,
+    EMBEDDING_MAX_INPUT_TOKENS,
+    EMBEDDING_MAX_BATCH_INPUTS,
+    EMBEDDING_MAX_BATCH_TOKENS
+)
+from embedding_cache import EmbeddingCache
+from response_cache import ResponseCache, cached_response, default_response_cache, is_valid_json, request_key
 
-client = OpenAI()
+try:
+    import columnar_flattened
+except ImportError:  # Only needed to read .parquet/.arrow flattened outputs (requires pyarrow)
+    columnar_flattened = None
 
-def chatGPT_api(message_content):
-    response = client.chat.completions.create(
-        model="gpt-4o",
-        response_format={'type': 'json_object'},
-        messages=[
+try:
+    import tiktoken
+except ImportError:  # Token counts fall back to a UTF-8 byte count (an upper bound)
+    tiktoken = None
+
+# Flattened output formats, in order of preference when a directory holds more than one.
+FLATTENED_EXTENSIONS = ('.json', '.parquet', '.arrow')
+
+CSV_FIELDS = ["File Name", "Case Number", "Officer Names", "Incident Dates", "Error"]
+
+# Retrieval planning: files whose records fit in RETRIEVAL_CONTEXT_TOKENS are passed to the
+# model whole, without embedding; FAISS is only used from FAISS_MIN_DOCUMENTS records up.
+# Otherwise records are ranked by relevance (at most RETRIEVAL_CANDIDATES of them) and packed
+# into the extraction prompt until RETRIEVAL_CONTEXT_TOKENS tokens of PROMPT_MODEL are used.
+RETRIEVAL_CONTEXT_TOKENS = 8000
+RETRIEVAL_CANDIDATES = 1000
+FAISS_MIN_DOCUMENTS = 5000
+PROMPT_MODEL = "gpt-4o"
+CONTEXT_SEPARATOR = "\n\n"
+
+@lru_cache(maxsize=None)
+def get_client():
+    """
+    Return the process-wide OpenAI client, created on first use so that runs with a local
+    embedding backend and cached chat responses need no API credentials.
+    """
+    return OpenAI()
+
+def chat_request(message_content):
+    """Return the chat.completions.create arguments used for an extraction prompt."""
+    return {
+        "model": "gpt-4o",
+        "response_format": {'type': 'json_object'},
+        "messages": [
             {"role": "user", "content": "Provide output in valid JSON."},
             {"role": "user", "content": message_content}
         ]
-    )
-    raw_response = response.choices[0].message.content
+    }
+
+def parse_chat_content(raw_response):
     try:
         structured_response = json.loads(raw_response)
         return structured_response
     except Exception as e:
         return {"error": "Failed to parse JSON", "raw_response": raw_response}
 
-def gpt_4o(prompt):
-    return chatGPT_api(prompt)
+def chatGPT_api(message_content, response_cache=None, bypass_cache=False):
+    """
+    Ask gpt-4o for a JSON answer. Responses are served from and stored in response_cache
+    (by default the cache named by $LLM_RESPONSE_CACHE, if any); bypass_cache=True always
+    calls the API and refreshes the cached response.
+    """
+    request = chat_request(message_content)
+    raw_response = cached_response(
+        response_cache or default_response_cache(), request_key(**request),
+        lambda: get_client().chat.completions.create(**request).choices[0].message.content,
+        model=request["model"], bypass=bypass_cache, cacheable=is_valid_json
+    )
+    return parse_chat_content(raw_response)
+
+def gpt_4o(prompt, response_cache=None, bypass_cache=False):
+    return chatGPT_api(prompt, response_cache, bypass_cache)
 
 # --- Helper Functions ---
 
@@ -37,94 +100,458 @@ def load_flattened_json(filepath):
         data = json.load(f)
     return data
 
+def load_flattened_records(filepath, result_store_path=None):
+    """
+    Load flattened records from a JSON or columnar (.parquet/.arrow) file, or from the result
+    store when filepath is a doc_key.
+    """
+    if result_store_path:
+        return result_store.read_flattened_document(result_store.get_result_store(result_store_path), filepath)
+    if filepath.endswith(('.parquet', '.arrow')):
+        if columnar_flattened is None:
+            raise ImportError("Reading columnar flattened files requires the pyarrow package (pip install pyarrow).")
+        return columnar_flattened.read_flattened_columnar(filepath)
+    return load_flattened_json(filepath)
+
+def get_file_id(filepath, base_dir, result_store_path=None):
+    """
+    Return the "File Name" reported for a flattened file: the parent folder of its
+    per-document output directory (the third-to-last path element).
+    """
+    if result_store_path:
+        # doc_keys are the per-document output directories relative to the flattened root.
+        relative_path = os.path.join(filepath, "flattened_structured_data.json")
+    else:
+        relative_path = os.path.relpath(filepath, base_dir)
+    parts = os.path.normpath(relative_path).split(os.sep)
+    if len(parts) >= 3:
+        return parts[-3]
+    return relative_path
+
+def dict_to_fields(flat_dict):
+    return [f"{k}: {v}" for k, v in flat_dict.items() if v is not None]
+
 def dict_to_text(flat_dict):
-    return "\n".join([f"{k}: {v}" for k, v in flat_dict.items() if v is not None])
+    return "\n".join(dict_to_fields(flat_dict))
 
 def get_embedding(text, model="text-embedding-ada-002"):
-    response = client.embeddings.create(input=text, model=model)
+    response = get_client().embeddings.create(input=text, model=model)
     return np.array(response.data[0].embedding)
 
-def compute_embeddings(documents, model="text-embedding-ada-002"):
-    embeddings = [get_embedding(doc, model=model) for doc in documents]
+# tiktoken encodings by model, loaded once per process (see get_token_encoding).
+_token_encodings = {}
+_token_encodings_lock = threading.Lock()
+
+def get_token_encoding(model):
+    """
+    Return the tiktoken encoding for a model, or None when tiktoken is not installed or its
+    encoding file cannot be loaded (tiktoken downloads it on first use, so offline runs without
+    a cached copy fall back to byte counts).
+    """
+    if tiktoken is None:
+        return None
+    with _token_encodings_lock:
+        if model not in _token_encodings:
+            try:
+                try:
+                    _token_encodings[model] = tiktoken.encoding_for_model(model)
+                except KeyError:
+                    _token_encodings[model] = tiktoken.get_encoding("cl100k_base")
+            except Exception as e:
+                print(f"Could not load the tiktoken encoding for {model}, counting UTF-8 bytes instead:", e)
+                _token_encodings[model] = None
+        return _token_encodings[model]
+
+def count_tokens(text, encoding):
+    """Count the tokens of text, or its UTF-8 bytes (an upper bound) without an encoding."""
+    if encoding is None:
+        return len(text.encode("utf-8"))
+    return len(encoding.encode(text, disallowed_special=()))
+
+def split_to_token_limit(text, encoding, max_tokens=EMBEDDING_MAX_INPUT_TOKENS):
+    """
+    Split text into (chunk, token_count) pieces of at most max_tokens tokens each.
+    Without an encoding, UTF-8 bytes stand in for tokens (no token is shorter than a byte).
+    """
+    if encoding is None:
+        data = text.encode("utf-8")
+        if len(data) <= max_tokens:
+            return [(text, len(data))]
+        return [(data[i:i + max_tokens].decode("utf-8", "ignore"), len(data[i:i + max_tokens]))
+                for i in range(0, len(data), max_tokens)]
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return [(text, len(tokens))]
+    return [(encoding.decode(tokens[i:i + max_tokens]), len(tokens[i:i + max_tokens]))
+            for i in range(0, len(tokens), max_tokens)]
+
+def iter_embedding_batches(inputs, max_inputs=EMBEDDING_MAX_BATCH_INPUTS, max_tokens=EMBEDDING_MAX_BATCH_TOKENS):
+    """Greedily pack (text, token_count) inputs, in order, into batches within the request limits."""
+    batch, batch_tokens = [], 0
+    for text, num_tokens in inputs:
+        if batch and (len(batch) == max_inputs or batch_tokens + num_tokens > max_tokens):
+            yield batch
+            batch, batch_tokens = [], 0
+        batch.append(text)
+        batch_tokens += num_tokens
+    if batch:
+        yield batch
+
+def resolve_embedding_backend(backend=None, model="text-embedding-ada-002"):
+    """
+    Return the EmbeddingBackend to use: backend itself, a backend looked up by name
+    (see embedding_backends.get_embedding_backend), or by default the OpenAI API with model.
+    """
+    if isinstance(backend, EmbeddingBackend):
+        return backend
+    if backend is None or backend == "openai":
+        return OpenAIEmbeddingBackend(get_client(), model)
+    return get_embedding_backend(backend)
+
+def compute_embeddings(documents, model="text-embedding-ada-002", oversize="chunk", cache=None, backend=None):
+    """
+    Embed documents with as few embeddings requests (backend.embed calls) as the backend's
+    limits allow and return an array with one row per document, in document order.
+    backend defaults to the OpenAI API with model (see resolve_embedding_backend).
+    Documents longer than the model's input limit are either split into chunks whose embeddings
+    are averaged (weighted by token count) and re-normalized (oversize="chunk"), or cut at the
+    limit (oversize="truncate"). Empty documents, which the API rejects, are embedded as " ".
+    With an EmbeddingCache, only inputs not already cached are sent, and new embeddings are stored.
+    """
+    backend = resolve_embedding_backend(backend, model)
+    inputs, owners, chunk_embeddings, missing = prepare_embedding_inputs(documents, backend, oversize, cache)
+    new_embeddings = []
+    for batch in iter_embedding_batches([inputs[i] for i in missing], backend.max_batch_inputs,
+                                        backend.max_batch_tokens):
+        new_embeddings.extend(backend.embed(batch))
+    return assemble_embeddings(documents, inputs, owners, chunk_embeddings, missing, new_embeddings, backend, cache)
+
+def prepare_embedding_inputs(documents, backend, oversize="chunk", cache=None):
+    """
+    Split documents into API inputs and look them up in the cache (see compute_embeddings).
+    Returns (inputs, owners, chunk_embeddings, missing): the (text, token_count) inputs, the
+    document each belongs to, the cached embedding of each input (or None), and the indices
+    of the distinct inputs that still have to be requested.
+    """
+    if backend.max_input_tokens is None:
+        # Token counts only matter for splitting and request limits.
+        inputs = [(doc or " ", 0) for doc in documents]
+        owners = list(range(len(documents)))
+    else:
+        inputs, owners = split_embedding_inputs(documents, backend, oversize)
+    texts = [text for text, _ in inputs]
+    chunk_embeddings = cache.get_many(texts, backend.model) if cache is not None else [None] * len(inputs)
+    # Identical inputs (boilerplate records) are only sent once.
+    missing = {}
+    for i, embedding in enumerate(chunk_embeddings):
+        if embedding is None:
+            missing.setdefault(texts[i], i)
+    return inputs, owners, chunk_embeddings, list(missing.values())
+
+def split_embedding_inputs(documents, backend, oversize="chunk"):
+    encoding = get_token_encoding(backend.model)
+    inputs = []
+    owners = []
+    for doc_index, doc in enumerate(documents):
+        chunks = split_to_token_limit(doc or " ", encoding, backend.max_input_tokens)
+        if oversize == "truncate":
+            chunks = chunks[:1]
+        inputs.extend(chunks)
+        owners.extend([doc_index] * len(chunks))
+    return inputs, owners
+
+def assemble_embeddings(documents, inputs, owners, chunk_embeddings, missing, new_embeddings, backend, cache=None):
+    """Combine cached and newly requested input embeddings into one row per document."""
+    texts = [text for text, _ in inputs]
+    embeddings_by_text = dict(zip((texts[i] for i in missing), new_embeddings))
+    for i, embedding in enumerate(chunk_embeddings):
+        if embedding is None:
+            chunk_embeddings[i] = embeddings_by_text[texts[i]]
+    if cache is not None and missing:
+        cache.put_many([texts[i] for i in missing], new_embeddings, backend.model)
+    if len(inputs) == len(documents):
+        return np.stack(chunk_embeddings)
+    parts = [[] for _ in documents]
+    for owner, (_, num_tokens), embedding in zip(owners, inputs, chunk_embeddings):
+        parts[owner].append((embedding, num_tokens))
+    embeddings = []
+    for doc_parts in parts:
+        if len(doc_parts) == 1:
+            embeddings.append(doc_parts[0][0])
+        else:
+            total = sum(embedding * num_tokens for embedding, num_tokens in doc_parts)
+            embeddings.append(total / np.linalg.norm(total))
     return np.stack(embeddings)
 
-def retrieve_documents_from_text(documents, query, k=5):
-    embeddings = compute_embeddings(documents)
-    d = embeddings.shape[1]
-    index = faiss.IndexFlatL2(d)
-    index.add(embeddings)
-    query_embedding = get_embedding(query)
-    query_embedding = np.expand_dims(query_embedding, axis=0)
-    distances, indices = index.search(query_embedding, k)
-    retrieved = [documents[i] for i in indices[0]]
-    return retrieved
+def build_retrieval_query(desired_fields):
+    """
+    Build the retrieval query for a set of desired fields, e.g. ["Case Number", "Officer Names",
+    "Incident Dates"] -> "Extract records that contain information about case numbers, officer
+    names, and incident dates."
+    """
+    topics = [field.lower() if field.lower().endswith("s") else f"{field.lower()}s" for field in desired_fields]
+    if len(topics) > 2:
+        topics = [", ".join(topics[:-1]) + ",", topics[-1]]
+    return f"Extract records that contain information about {' and '.join(topics)}."
+
+_query_embeddings = {}
+_query_embeddings_lock = threading.Lock()
+
+def get_query_embedding(query, model="text-embedding-ada-002", cache=None, backend=None):
+    """
+    Return the embedding of a retrieval query, computed once per process for each distinct
+    (query, embedding model) and shared by all threads; with an EmbeddingCache it is also
+    persisted across runs.
+    """
+    backend = resolve_embedding_backend(backend, model)
+    key = (query, backend.model)
+    with _query_embeddings_lock:
+        if key not in _query_embeddings:
+            _query_embeddings[key] = compute_embeddings([query], cache=cache, backend=backend)[0]
+        return _query_embeddings[key]
+
+def plan_retrieval(documents, context_tokens=RETRIEVAL_CONTEXT_TOKENS, faiss_min_documents=FAISS_MIN_DOCUMENTS,
+                   model=PROMPT_MODEL):
+    """
+    Choose how to retrieve context from a file's records:
+    "all" when they all fit in context_tokens (no embedding needed), "numpy" for an exact
+    brute-force ranking below faiss_min_documents records, and "faiss" above it.
+    """
+    encoding = get_token_encoding(model)
+    separator_tokens = count_tokens(CONTEXT_SEPARATOR, encoding)
+    total = -separator_tokens
+    for doc in documents:
+        total += count_tokens(doc, encoding) + separator_tokens
+        if total > context_tokens:
+            break
+    else:
+        return "all"
+    return "numpy" if len(documents) < faiss_min_documents else "faiss"
+
+def nearest_neighbors(embeddings, query_embedding, k, method="numpy"):
+    """Return the indices of the k embeddings closest to query_embedding (L2), nearest first."""
+    if method == "faiss":
+        index = faiss.IndexFlatL2(embeddings.shape[1])
+        index.add(embeddings)
+        _, indices = index.search(np.expand_dims(query_embedding, axis=0), k)
+        return indices[0].tolist()
+    distances = np.square(embeddings - query_embedding).sum(axis=1)
+    candidates = np.argpartition(distances, k - 1)[:k] if k < len(distances) else np.arange(len(distances))
+    return candidates[np.lexsort((candidates, distances[candidates]))].tolist()
+
+def rank_documents(documents, query, k=RETRIEVAL_CANDIDATES, embedding_cache=None, embedding_backend=None,
+                   context_tokens=RETRIEVAL_CONTEXT_TOKENS):
+    """
+    Return the indices of up to k documents in order of relevance to query (see plan_retrieval).
+    Files that fit in context_tokens are returned whole, in file order, without embedding.
+    """
+    method = plan_retrieval(documents, context_tokens)
+    if method == "all":
+        return list(range(len(documents)))
+    embeddings = compute_embeddings(documents, cache=embedding_cache, backend=embedding_backend)
+    query_embedding = get_query_embedding(query, cache=embedding_cache, backend=embedding_backend)
+    return nearest_neighbors(embeddings, query_embedding, min(k, len(documents)), method)
+
+def pack_context(records, context_tokens=RETRIEVAL_CONTEXT_TOKENS, model=PROMPT_MODEL):
+    """
+    Greedily pack flattened records, given most relevant first, into at most context_tokens
+    tokens of the prompt model; returns (documents, tokens_used).
+
+    A record that does not fit in the remaining budget is cut after its last field that does
+    (never inside a field); if not even its first field fits, it is skipped and smaller, less
+    relevant records still get a chance. Only when nothing at all has been packed is a single
+    oversize field cut by tokens, so the prompt is never left without context.
+    Without tiktoken, UTF-8 bytes stand in for tokens, which can only undercount the budget.
+    """
+    encoding = get_token_encoding(model)
+    separator_tokens = count_tokens(CONTEXT_SEPARATOR, encoding)
+    newline_tokens = count_tokens("\n", encoding)
+    documents, used = [], 0
+    for record in records:
+        remaining = context_tokens - used - (separator_tokens if documents else 0)
+        if remaining <= 0:
+            break
+        fields, tokens = [], 0
+        for field in dict_to_fields(record):
+            field_tokens = count_tokens(field, encoding) + (newline_tokens if fields else 0)
+            if tokens + field_tokens > remaining:
+                if not fields and not documents:
+                    field, field_tokens = split_to_token_limit(field, encoding, remaining)[0]
+                    fields.append(field)
+                    tokens += field_tokens
+                break
+            fields.append(field)
+            tokens += field_tokens
+        if fields:
+            used += tokens + (separator_tokens if documents else 0)
+            documents.append("\n".join(fields))
+    return documents, used
 
 # --- Process a Single File to Extract a Record ---
-def process_single_file_extract_record(filepath, base_dir, desired_fields=["Case Number", "Officer Names", "Incident Dates"]):
+def build_extraction_prompt(retrieved_docs, desired_fields):
+    context = CONTEXT_SEPARATOR.join(retrieved_docs)
+    return (
+        f"Below are several records extracted from police documents:\n\n{context}\n\n"
+        f"Using fuzzy matching and context, extract the following fields: {', '.join(desired_fields)}. "
+        "If multiple values exist for a field, list them separated by semicolons. "
+        "Return the results as JSON, for example: "
+        '{"Case Number": "value", "Officer Names": "value", "Incident Dates": "value"}'
+    )
+
+def error_record(filepath, base_dir, result_store_path=None):
+    """Report the exception being handled as the CSV record of a file that failed."""
+    err_trace = traceback.format_exc()
+    print(f"Error processing file {filepath}:\n{err_trace}")
+    return {
+        "File Name": get_file_id(filepath, base_dir, result_store_path),
+        "Case Number": "",
+        "Officer Names": "",
+        "Incident Dates": "",
+        "Error": err_trace
+    }
+
+def report_context(filepath, data, retrieved_docs, context_tokens):
+    print(f"Context for {filepath}: {len(retrieved_docs)} of {len(data)} records, {context_tokens} tokens.")
+
+def process_single_file_extract_record(filepath, base_dir, desired_fields=["Case Number", "Officer Names", "Incident Dates"],
+                                       result_store_path=None, embedding_cache=None, embedding_backend=None,
+                                       response_cache=None, bypass_response_cache=False,
+                                       context_tokens=RETRIEVAL_CONTEXT_TOKENS):
+    """
+    Extract desired_fields from one flattened file: rank its records by relevance to the
+    fields, pack them into a context_tokens budget (see pack_context) and ask the model.
+    """
     print(f"Processing file: {filepath}")
     try:
-        data = load_flattened_json(filepath)
+        data = load_flattened_records(filepath, result_store_path)
         documents = [dict_to_text(doc) for doc in data]
-        query = "Extract records that contain information about case numbers, officer names, and incident dates."
-        retrieved_docs = retrieve_documents_from_text(documents, query, k=5)
-        context = "\n\n".join(retrieved_docs)
-        prompt = (
-            f"Below are several records extracted from police documents:\n\n{context}\n\n"
-            f"Using fuzzy matching and context, extract the following fields: {', '.join(desired_fields)}. "
-            "If multiple values exist for a field, list them separated by semicolons. "
-            "Return the results as JSON, for example: "
-            '{"Case Number": "value", "Officer Names": "value", "Incident Dates": "value"}'
-        )
-        response = gpt_4o(prompt)
+        query = build_retrieval_query(desired_fields)
+        ranking = rank_documents(documents, query, embedding_cache=embedding_cache,
+                                 embedding_backend=embedding_backend, context_tokens=context_tokens)
+        retrieved_docs, used_tokens = pack_context([data[i] for i in ranking], context_tokens)
+        report_context(filepath, data, retrieved_docs, used_tokens)
+        prompt = build_extraction_prompt(retrieved_docs, desired_fields)
+        response = gpt_4o(prompt, response_cache, bypass_response_cache)
         record = response  # Expecting a dict
 
-        # Compute the relative path and extract the parent folder (third-to-last element)
-        relative_path = os.path.relpath(filepath, base_dir)
-        parts = os.path.normpath(relative_path).split(os.sep)
-        if len(parts) >= 3:
-            file_id = parts[-3]
-        else:
-            file_id = relative_path
-        record["File Name"] = file_id
-        record["Error"] = ""
+        # Extract the parent folder (third-to-last element of the relative path)
+        record["File Name"] = get_file_id(filepath, base_dir, result_store_path)
+        # An answer that did not parse (see parse_chat_content) is a failure, so resumed runs retry it.
+        record["Error"] = record.get("error", "")
         print(f"Finished processing file: {filepath}")
         return record
     except Exception as e:
-        err_trace = traceback.format_exc()
-        print(f"Error processing file {filepath}:\n{err_trace}")
-        relative_path = os.path.relpath(filepath, base_dir)
-        parts = os.path.normpath(relative_path).split(os.sep)
-        if len(parts) >= 3:
-            file_id = parts[-3]
-        else:
-            file_id = relative_path
-        return {
-            "File Name": file_id,
-            "Case Number": "",
-            "Officer Names": "",
-            "Incident Dates": "",
-            "Error": err_trace
-        }
+        return error_record(filepath, base_dir, result_store_path)
 
 # --- Process Multiple Files Concurrently and Combine into One CSV ---
-def process_structured_extraction_directories(input_dir, desired_fields=["Case Number", "Officer Names", "Incident Dates"]):
+def open_response_cache(response_cache_path=None, response_cache_ttl=None):
+    if response_cache_path:
+        return ResponseCache(response_cache_path, ttl=response_cache_ttl)
+    return default_response_cache()
+
+def start_record_output(filepaths, output_csv_path=None, csv_fields=None, resume=True):
+    """
+    Open the incremental record output of a run, if any.
+    Returns (record_writer, records, filepaths): the writer (or None), the records carried over
+    from an earlier run, and the filepaths that still have to be processed.
+    """
+    if not output_csv_path:
+        return None, [], filepaths
+    record_writer = IncrementalRecordWriter(output_csv_path, csv_fields or CSV_FIELDS, resume)
+    remaining = [fp for fp in filepaths if fp not in record_writer.completed]
+    if len(remaining) < len(filepaths):
+        print(f"Skipping {len(filepaths) - len(remaining)} files already extracted into {output_csv_path}.")
+    return record_writer, list(record_writer.completed.values()), remaining
+
+def report_caches(embedding_cache=None, response_cache=None, close_response_cache=False):
+    """
+    Print the hit/miss counters of a run's caches and close the ones the run opened
+    (the process-wide default response cache stays open).
+    """
+    if embedding_cache is not None:
+        print("Embedding cache:", embedding_cache.stats())
+        embedding_cache.close()
+    if response_cache is not None:
+        print("Response cache:", response_cache.stats())
+        if close_response_cache:
+            response_cache.close()
+
+def list_flattened_files(input_dir, result_store_path=None, extensions=FLATTENED_EXTENSIONS):
+    """
+    Return the flattened files under input_dir (or the doc_keys in the result store).
+    A document directory flattened in several formats is listed once, in the first of
+    extensions it has, so it is never extracted twice.
+    """
+    if result_store_path:
+        # Query the flattened documents from the result store instead of walking input_dir.
+        store = result_store.get_result_store(result_store_path)
+        return result_store.list_documents(store, result_store.FLATTENED_STAGE)
     filepaths = []
     for root, _, files in os.walk(input_dir):
-        for file in files:
-            if file.endswith('.json'):
-                filepaths.append(os.path.join(root, file))
+        for extension in extensions:
+            matches = sorted(file for file in files if file.endswith(extension))
+            if matches:
+                filepaths.extend(os.path.join(root, file) for file in matches)
+                break
+    return filepaths
+
+def process_structured_extraction_directories(input_dir, desired_fields=["Case Number", "Officer Names", "Incident Dates"],
+                                              result_store_path=None, embedding_cache_dir=None, use_async=False,
+                                              embedding_backend=None, response_cache_path=None, response_cache_ttl=None,
+                                              bypass_response_cache=False, output_csv_path=None, csv_fields=None,
+                                              resume=True, context_tokens=RETRIEVAL_CONTEXT_TOKENS):
+    """
+    Extract a record from every flattened file under input_dir (or in the result store).
+    With embedding_cache_dir set, record embeddings are read from and added to the
+    persistent EmbeddingCache in that directory, and its hit/miss counters are printed.
+    use_async=True runs the asyncio pipeline with adaptive concurrency instead of a fixed
+    thread pool (see process_structured_extraction_directories_async).
+    embedding_backend selects the embedding model for this run: an EmbeddingBackend, or a name
+    such as "openai" (the default), "hashing" or "sentence-transformers" for local CPU embeddings.
+    With response_cache_path set (or $LLM_RESPONSE_CACHE), chat responses are cached in a
+    ResponseCache with the given TTL in seconds, so unchanged files replay without API calls;
+    bypass_response_cache=True re-asks every prompt and refreshes the cache.
+    With output_csv_path set, every record is written to the CSV (and its sidecar JSONL log) as
+    soon as its file completes, and with resume=True files that already succeeded in an earlier
+    run are skipped (see IncrementalRecordWriter). The returned records include those.
+    context_tokens bounds the records put into each extraction prompt (see pack_context).
+    """
+    if use_async:
+        return asyncio.run(process_structured_extraction_directories_async(
+            input_dir, desired_fields, result_store_path, embedding_cache_dir, embedding_backend=embedding_backend,
+            response_cache_path=response_cache_path, response_cache_ttl=response_cache_ttl,
+            bypass_response_cache=bypass_response_cache, output_csv_path=output_csv_path, csv_fields=csv_fields,
+            resume=resume, context_tokens=context_tokens
+        ))
+    embedding_backend = resolve_embedding_backend(embedding_backend)
+    response_cache = open_response_cache(response_cache_path, response_cache_ttl)
+    embedding_cache = EmbeddingCache(embedding_cache_dir) if embedding_cache_dir else None
+    # Embed the query once up front; every worker then reuses it.
+    try:
+        get_query_embedding(build_retrieval_query(desired_fields), cache=embedding_cache, backend=embedding_backend)
+    except Exception as e:
+        print("Error embedding the retrieval query (each file will retry):", e)
+    record_writer, records, filepaths = start_record_output(list_flattened_files(input_dir, result_store_path),
+                                                            output_csv_path, csv_fields, resume)
     print(f"Processing {len(filepaths)} files.")
     
-    records = []
     with ThreadPoolExecutor(max_workers=5) as executor:
-        futures = [executor.submit(process_single_file_extract_record, fp, input_dir, desired_fields) for fp in filepaths]
+        futures = {executor.submit(process_single_file_extract_record, fp, input_dir, desired_fields, result_store_path,
+                                   embedding_cache, embedding_backend, response_cache, bypass_response_cache,
+                                   context_tokens): fp
+                   for fp in filepaths}
         for future in as_completed(futures):
             try:
                 rec = future.result()
                 records.append(rec)
+                if record_writer is not None:
+                    record_writer.write(futures[future], rec)
                 print("File processed successfully.")
             except Exception as e:
                 print("Error processing a file:", e)
+    if record_writer is not None:
+        record_writer.close()
+    report_caches(embedding_cache, response_cache, close_response_cache=bool(response_cache_path))
     return records
 
 def write_records_to_csv(records, output_csv_path, desired_fields=["File Name", "Case Number", "Officer Names", "Incident Dates", "Error"]):
@@ -134,6 +561,237 @@ def write_records_to_csv(records, output_csv_path, desired_fields=["File Name",
         for rec in records:
             writer.writerow(rec)
 
+def record_log_path(output_csv_path):
+    """Return the sidecar JSONL log kept next to an output CSV."""
+    return os.path.splitext(output_csv_path)[0] + ".records.jsonl"
+
+def load_record_log(log_path):
+    """
+    Return {filepath: record} from a record log, keeping the last record of each file.
+    Lines that are not a complete {"file": ..., "record": {...}} entry, such as a last line
+    truncated by a crash mid-write, are ignored.
+    """
+    records = {}
+    if not os.path.exists(log_path):
+        return records
+    with open(log_path, "r") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(entry, dict) and "file" in entry and isinstance(entry.get("record"), dict):
+                records[entry["file"]] = entry["record"]
+    return records
+
+class IncrementalRecordWriter:
+    """
+    Writes each extracted record as soon as its file finishes: one line to the sidecar JSONL log
+    (keyed by the input filepath, so runs can resume) and one row to the CSV, both flushed.
+
+    With resume=True, files whose logged record has an empty "Error" (and no "error" from an
+    unparseable answer) are reported by completed and their rows are carried over into the
+    rewritten CSV; failed files are dropped from the CSV so that they can be retried.
+    With resume=False both outputs start empty.
+    """
+    def __init__(self, output_csv_path, fieldnames=CSV_FIELDS, resume=True):
+        self.log_path = record_log_path(output_csv_path)
+        logged = load_record_log(self.log_path) if resume else {}
+        self.completed = {fp: record for fp, record in logged.items()
+                          if record.get("Error") == "" and "error" not in record}
+        # Rewrite both files from the completed records, then append to them.
+        partial_csv, partial_log = output_csv_path + ".partial", self.log_path + ".partial"
+        with open(partial_csv, "w", newline="") as csvfile, open(partial_log, "w") as logfile:
+            writer = csv.DictWriter(csvfile, fieldnames=fieldnames, extrasaction="ignore")
+            writer.writeheader()
+            for fp, record in self.completed.items():
+                writer.writerow(record)
+                logfile.write(json.dumps({"file": fp, "record": record}) + "\n")
+        os.replace(partial_csv, output_csv_path)
+        os.replace(partial_log, self.log_path)
+        self.lock = threading.Lock()
+        self.csvfile = open(output_csv_path, "a", newline="")
+        self.logfile = open(self.log_path, "a")
+        self.writer = csv.DictWriter(self.csvfile, fieldnames=fieldnames, extrasaction="ignore")
+
+    def write(self, filepath, record):
+        with self.lock:
+            self.logfile.write(json.dumps({"file": filepath, "record": record}) + "\n")
+            self.logfile.flush()
+            self.writer.writerow(record)
+            self.csvfile.flush()
+
+    def close(self):
+        self.csvfile.close()
+        self.logfile.close()
+
+# --- Async Pipeline ---
+# 429s and timeouts shrink the concurrency limit of the API they came from; the async client
+# is created with max_retries=0 so those errors reach the limiter instead of being retried inside it.
+CONGESTION_ERRORS = (openai.RateLimitError, openai.APITimeoutError, asyncio.TimeoutError)
+
+class LazyAsyncClient:
+    """
+    Stands in for an AsyncOpenAI client that is created on first attribute access, like
+    get_client(), so runs with a local embedding backend and cached chat responses need no
+    API credentials.
+    """
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.client = None
+
+    def __getattr__(self, name):
+        if self.client is None:
+            self.client = AsyncOpenAI(**self.kwargs)
+        return getattr(self.client, name)
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.close()
+
+async def chatGPT_api_async(aclient, limiter, message_content, response_cache=None, bypass_cache=False):
+    """chatGPT_api through the async client; cache hits do not take a slot under limiter."""
+    request = chat_request(message_content)
+    response_cache = response_cache or default_response_cache()
+    key = request_key(**request)
+    if response_cache is not None and not bypass_cache:
+        raw_response = response_cache.get(key)
+        if raw_response is not None:
+            return parse_chat_content(raw_response)
+    response = await limiter.call(aclient.chat.completions.create, **request)
+    raw_response = response.choices[0].message.content
+    if response_cache is not None and raw_response is not None and is_valid_json(raw_response):
+        response_cache.put(key, raw_response, request["model"])
+    return parse_chat_content(raw_response)
+
+async def get_embeddings_async(aclient, texts, model="text-embedding-ada-002"):
+    response = await aclient.embeddings.create(input=texts, model=model)
+    return [np.array(item.embedding) for item in sorted(response.data, key=lambda item: item.index)]
+
+async def embed_batch_async(aclient, limiter, backend, batch):
+    """Embed one batch: remote (OpenAI) backends through the async client under limiter, local ones in a thread."""
+    if backend.remote:
+        return await limiter.call(get_embeddings_async, aclient, batch, backend.model)
+    return await asyncio.to_thread(backend.embed, batch)
+
+async def compute_embeddings_async(aclient, limiter, documents, model="text-embedding-ada-002", oversize="chunk",
+                                   cache=None, backend=None):
+    """compute_embeddings with the batches sent concurrently under limiter."""
+    backend = resolve_embedding_backend(backend, model)
+    inputs, owners, chunk_embeddings, missing = prepare_embedding_inputs(documents, backend, oversize, cache)
+    batches = list(iter_embedding_batches([inputs[i] for i in missing], backend.max_batch_inputs,
+                                          backend.max_batch_tokens))
+    results = await asyncio.gather(*(embed_batch_async(aclient, limiter, backend, batch) for batch in batches))
+    new_embeddings = [embedding for batch in results for embedding in batch]
+    return assemble_embeddings(documents, inputs, owners, chunk_embeddings, missing, new_embeddings, backend, cache)
+
+async def get_query_embedding_async(aclient, limiter, query, model="text-embedding-ada-002", cache=None,
+                                    backend=None):
+    """get_query_embedding through the async client; shares the same per-process memo."""
+    backend = resolve_embedding_backend(backend, model)
+    key = (query, backend.model)
+    if key not in _query_embeddings:
+        embedding = (await compute_embeddings_async(aclient, limiter, [query], cache=cache, backend=backend))[0]
+        with _query_embeddings_lock:
+            _query_embeddings.setdefault(key, embedding)
+    return _query_embeddings[key]
+
+async def rank_documents_async(aclient, limiter, documents, query, k=RETRIEVAL_CANDIDATES, embedding_cache=None,
+                               embedding_backend=None, context_tokens=RETRIEVAL_CONTEXT_TOKENS):
+    method = plan_retrieval(documents, context_tokens)
+    if method == "all":
+        return list(range(len(documents)))
+    embeddings = await compute_embeddings_async(aclient, limiter, documents, cache=embedding_cache,
+                                                backend=embedding_backend)
+    query_embedding = await get_query_embedding_async(aclient, limiter, query, cache=embedding_cache,
+                                                      backend=embedding_backend)
+    return nearest_neighbors(embeddings, query_embedding, min(k, len(documents)), method)
+
+async def process_single_file_extract_record_async(aclient, limiters, filepath, base_dir,
+                                                   desired_fields=["Case Number", "Officer Names", "Incident Dates"],
+                                                   result_store_path=None, embedding_cache=None,
+                                                   embedding_backend=None, response_cache=None,
+                                                   bypass_response_cache=False,
+                                                   context_tokens=RETRIEVAL_CONTEXT_TOKENS):
+    """process_single_file_extract_record with API calls made through the AIMD limiters."""
+    print(f"Processing file: {filepath}")
+    try:
+        data = await asyncio.to_thread(load_flattened_records, filepath, result_store_path)
+        documents = [dict_to_text(doc) for doc in data]
+        query = build_retrieval_query(desired_fields)
+        ranking = await rank_documents_async(aclient, limiters["embeddings"], documents, query,
+                                             embedding_cache=embedding_cache, embedding_backend=embedding_backend,
+                                             context_tokens=context_tokens)
+        retrieved_docs, used_tokens = pack_context([data[i] for i in ranking], context_tokens)
+        report_context(filepath, data, retrieved_docs, used_tokens)
+        prompt = build_extraction_prompt(retrieved_docs, desired_fields)
+        record = await chatGPT_api_async(aclient, limiters["chat"], prompt, response_cache, bypass_response_cache)
+        record["File Name"] = get_file_id(filepath, base_dir, result_store_path)
+        # An answer that did not parse (see parse_chat_content) is a failure, so resumed runs retry it.
+        record["Error"] = record.get("error", "")
+        print(f"Finished processing file: {filepath}")
+        return record
+    except Exception as e:
+        return error_record(filepath, base_dir, result_store_path)
+
+async def process_structured_extraction_directories_async(input_dir,
+                                                          desired_fields=["Case Number", "Officer Names", "Incident Dates"],
+                                                          result_store_path=None, embedding_cache_dir=None,
+                                                          max_files_in_flight=64, request_timeout=60.0,
+                                                          chat_limiter=None, embedding_limiter=None,
+                                                          embedding_backend=None, response_cache_path=None,
+                                                          response_cache_ttl=None, bypass_response_cache=False,
+                                                          output_csv_path=None, csv_fields=None, resume=True,
+                                                          context_tokens=RETRIEVAL_CONTEXT_TOKENS):
+    """
+    Asyncio version of process_structured_extraction_directories.
+    Chat completions and embeddings each get their own AIMDLimiter, so each API's concurrency
+    grows while requests succeed and backs off on its own 429s and timeouts. At most
+    max_files_in_flight files are loaded and processed at once. Local embedding backends run in
+    worker threads instead of under the embeddings limiter.
+    """
+    embedding_backend = resolve_embedding_backend(embedding_backend)
+    response_cache = open_response_cache(response_cache_path, response_cache_ttl)
+    limiters = {
+        "chat": chat_limiter or AIMDLimiter("chat", retry_on=CONGESTION_ERRORS),
+        "embeddings": embedding_limiter or AIMDLimiter("embeddings", retry_on=CONGESTION_ERRORS)
+    }
+    embedding_cache = EmbeddingCache(embedding_cache_dir) if embedding_cache_dir else None
+    filepaths = await asyncio.to_thread(list_flattened_files, input_dir, result_store_path)
+    record_writer, records, filepaths = start_record_output(filepaths, output_csv_path, csv_fields, resume)
+    print(f"Processing {len(filepaths)} files.")
+    aclient = LazyAsyncClient(max_retries=0, timeout=request_timeout)
+    try:
+        try:
+            await get_query_embedding_async(aclient, limiters["embeddings"], build_retrieval_query(desired_fields),
+                                            cache=embedding_cache, backend=embedding_backend)
+        except Exception as e:
+            print("Error embedding the retrieval query (each file will retry):", e)
+        files_in_flight = asyncio.Semaphore(max_files_in_flight)
+
+        async def process(filepath):
+            async with files_in_flight:
+                return filepath, await process_single_file_extract_record_async(aclient, limiters, filepath, input_dir,
+                                                                                desired_fields, result_store_path,
+                                                                                embedding_cache, embedding_backend,
+                                                                                response_cache, bypass_response_cache,
+                                                                                context_tokens)
+
+        for task in asyncio.as_completed([process(fp) for fp in filepaths]):
+            filepath, record = await task
+            records.append(record)
+            if record_writer is not None:
+                record_writer.write(filepath, record)
+            print("File processed successfully.")
+    finally:
+        await aclient.close()
+    if record_writer is not None:
+        record_writer.close()
+    for limiter in limiters.values():
+        print("Concurrency:", limiter.stats())
+    report_caches(embedding_cache, response_cache, close_response_cache=bool(response_cache_path))
+    return records
+
 # --- Main Entry Point ---
 if __name__ == "__main__":
     input_dir = "../tst/structured_extraction_flattened_gpt_4o"  # Directory with flattened JSON files
@@ -143,6 +801,7 @@ if __name__ == "__main__":
     desired_fields = ["Case Number", "Officer Names", "Incident Dates"]
     csv_fields = ["File Name", "Case Number", "Officer Names", "Incident Dates", "Error"]
     
-    records = process_structured_extraction_directories(input_dir, desired_fields)
-    write_records_to_csv(records, output_csv_path, csv_fields)
+    # Records are written as files finish; re-running resumes after the files that succeeded.
+    records = process_structured_extraction_directories(input_dir, desired_fields, output_csv_path=output_csv_path,
+                                                        csv_fields=csv_fields)
     print(f"CSV file saved as {output_csv_path}")
@@ -0,0 +1,130 @@
+import re
+import zlib
+from abc import ABC, abstractmethod
+from collections import Counter
+
+import numpy as np
+
+try:
+    from sentence_transformers import SentenceTransformer
+except ImportError:  # Only needed for SentenceTransformerBackend
+    SentenceTransformer = None
+
+# Embeddings API limits: tokens per input, inputs per request and tokens per request.
+EMBEDDING_MAX_INPUT_TOKENS = 8191
+EMBEDDING_MAX_BATCH_INPUTS = 2048
+EMBEDDING_MAX_BATCH_TOKENS = 300000
+
+class EmbeddingBackend(ABC):
+    """
+    Interface for the embedding models dynamic_search can retrieve with.
+
+    model names the backend's vector space; it is part of embedding cache keys, so two
+    backends must only share a name if their vectors are interchangeable.
+    embed(texts) returns one 1-D float array per text, in order. Inputs are split at
+    max_input_tokens (None: never split) and batched up to max_batch_inputs texts and
+    max_batch_tokens tokens per embed() call. remote backends are network APIs, called
+    under the async pipeline's concurrency limiter; local ones run in worker threads.
+    """
+    model = None
+    remote = False
+    max_input_tokens = None
+    max_batch_inputs = 256
+    max_batch_tokens = float("inf")
+
+    @abstractmethod
+    def embed(self, texts):
+        """Return one 1-D float array per text, in order."""
+
+class OpenAIEmbeddingBackend(EmbeddingBackend):
+    """Embeddings from the OpenAI API (the default)."""
+    remote = True
+    max_input_tokens = EMBEDDING_MAX_INPUT_TOKENS
+    max_batch_inputs = EMBEDDING_MAX_BATCH_INPUTS
+    max_batch_tokens = EMBEDDING_MAX_BATCH_TOKENS
+
+    def __init__(self, client, model="text-embedding-ada-002"):
+        self.client = client
+        self.model = model
+
+    def embed(self, texts):
+        response = self.client.embeddings.create(input=texts, model=self.model)
+        return [np.array(item.embedding) for item in sorted(response.data, key=lambda item: item.index)]
+
+# Word characters without "_", so flattened key paths like "case_number" split into words.
+TOKEN_PATTERN = re.compile(r"[^\W_]+")
+
+class HashingEmbeddingBackend(EmbeddingBackend):
+    """
+    Local, dependency-free bag-of-n-grams embeddings (the "hashing trick").
+
+    Lower-cased word n-grams are hashed with CRC32 into dim buckets with a hash-derived sign,
+    term counts are log-scaled and rows are L2-normalized, so L2 distance ranks records by
+    cosine similarity of their (hashed) vocabularies. Hashes are stable across processes,
+    so vectors can be cached.
+    """
+    def __init__(self, dim=1024, ngram_range=(1, 2)):
+        self.dim = dim
+        self.ngram_range = ngram_range
+        self.model = f"hashing-{dim}-ngram{ngram_range[0]}-{ngram_range[1]}"
+
+    def features(self, text):
+        tokens = TOKEN_PATTERN.findall(text.lower())
+        low, high = self.ngram_range
+        for n in range(low, high + 1):
+            for i in range(len(tokens) - n + 1):
+                yield " ".join(tokens[i:i + n])
+
+    def embed(self, texts):
+        rows, buckets, signs = [], [], []
+        hashed = {}
+        for row, text in enumerate(texts):
+            for feature, count in Counter(self.features(text)).items():
+                if feature not in hashed:
+                    h = zlib.crc32(feature.encode("utf-8"))
+                    hashed[feature] = (h % self.dim, 1.0 if h & 0x80000000 else -1.0)
+                bucket, sign = hashed[feature]
+                rows.append(row)
+                buckets.append(bucket)
+                signs.append(sign * count)
+        counts = np.zeros((len(texts), self.dim))
+        np.add.at(counts, (np.array(rows, dtype=np.int64), np.array(buckets, dtype=np.int64)), signs)
+        vectors = np.sign(counts) * np.log1p(np.abs(counts))
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors /= np.where(norms == 0, 1.0, norms)
+        return list(vectors)
+
+class SentenceTransformerBackend(EmbeddingBackend):
+    """
+    Local sentence-transformers model run on the CPU (or another torch device), with
+    batched inference. Texts longer than the model's sequence length are truncated by the model.
+    """
+    def __init__(self, model_name="sentence-transformers/all-MiniLM-L6-v2", batch_size=64, device="cpu"):
+        if SentenceTransformer is None:
+            raise ImportError("SentenceTransformerBackend requires the sentence-transformers package "
+                              "(pip install sentence-transformers).")
+        self.model = model_name
+        self.batch_size = batch_size
+        self.max_batch_inputs = batch_size * 16
+        self.encoder = SentenceTransformer(model_name, device=device)
+
+    def embed(self, texts):
+        vectors = self.encoder.encode(texts, batch_size=self.batch_size, convert_to_numpy=True,
+                                      normalize_embeddings=True, show_progress_bar=False)
+        return list(vectors.astype(np.float64))
+
+EMBEDDING_BACKENDS = {
+    "hashing": HashingEmbeddingBackend,
+    "sentence-transformers": SentenceTransformerBackend
+}
+
+def get_embedding_backend(name, client=None, **kwargs):
+    """
+    Return an embedding backend by name: "openai" (requires client), "hashing" or
+    "sentence-transformers"; kwargs go to the backend's constructor.
+    """
+    if name == "openai":
+        return OpenAIEmbeddingBackend(client, **kwargs)
+    if name not in EMBEDDING_BACKENDS:
+        raise ValueError(f"Unknown embedding backend: {name}")
+    return EMBEDDING_BACKENDS[name](**kwargs)
@@ -0,0 +1,173 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+# An embedding cache directory holds one SQLite index and one flat float32 vector file per
+# embedding dimension. The index maps hash(model, text) to a row ("slot") of the vector file,
+# which is memory-mapped, so cached vectors are read without parsing anything.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS embeddings (
+    key TEXT PRIMARY KEY,
+    dim INTEGER NOT NULL,
+    slot INTEGER NOT NULL,
+    last_used REAL NOT NULL,
+    UNIQUE (dim, slot)
+);
+CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used);
+CREATE TABLE IF NOT EXISTS free_slots (
+    dim INTEGER NOT NULL,
+    slot INTEGER NOT NULL,
+    PRIMARY KEY (dim, slot)
+);
+CREATE TABLE IF NOT EXISTS slot_counts (
+    dim INTEGER PRIMARY KEY,
+    allocated INTEGER NOT NULL
+);
+"""
+
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+def embedding_key(text, model):
+    """Return the content address of an embedding: sha256 of the model name and the exact input text."""
+    return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+class EmbeddingCache:
+    """
+    Persistent, content-addressed embedding cache shared by the threads of one process.
+
+    Vectors are stored as float32 (what FAISS searches with anyway). When the vectors stored
+    exceed max_bytes, the least recently used entries are evicted and their slots reused.
+    hits, misses and evictions count lookups and evictions made through this object.
+    """
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(os.path.join(directory, "index.sqlite"), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self.vectors = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def vector_path(self, dim):
+        return os.path.join(self.directory, f"vectors-{dim}.f32")
+
+    def vector_file(self, dim, min_slots=0):
+        """Return the memory map of the dim-wide vector file, growing the file to hold min_slots rows."""
+        vectors = self.vectors.get(dim)
+        if vectors is not None and len(vectors) >= min_slots:
+            return vectors
+        path = self.vector_path(dim)
+        row_bytes = dim * np.dtype(np.float32).itemsize
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        if size < min_slots * row_bytes:
+            # Grow geometrically so appends do not remap the file every time.
+            size = max(min_slots, 2 * (size // row_bytes), 1024) * row_bytes
+            with open(path, "ab") as f:
+                f.truncate(size)
+        if size == 0:
+            return None
+        vectors = self.vectors[dim] = np.memmap(path, dtype=np.float32, mode="r+", shape=(size // row_bytes, dim))
+        return vectors
+
+    def get_many(self, texts, model):
+        """Return a list with the cached embedding (float64 array) of each text, or None on a miss."""
+        keys = [embedding_key(text, model) for text in texts]
+        found = {}
+        with self.lock:
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                rows = self.conn.execute(
+                    f"SELECT key, dim, slot FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})", chunk
+                )
+                for key, dim, slot in rows:
+                    found[key] = np.array(self.vector_file(dim)[slot], dtype=np.float64)
+            if found:
+                now = time.time()
+                with self.conn:
+                    self.conn.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?",
+                                          [(now, key) for key in found])
+            results = [found.get(key) for key in keys]
+            hits = sum(result is not None for result in results)
+            self.hits += hits
+            self.misses += len(results) - hits
+        return results
+
+    def put_many(self, texts, embeddings, model):
+        """
+        Store the embedding of each text, then evict least recently used entries over max_bytes.
+        The vector file is flushed before the index is committed.
+        """
+        with self.lock:
+            now = time.time()
+            with self.conn:
+                for text, embedding in zip(texts, embeddings):
+                    key = embedding_key(text, model)
+                    if self.conn.execute("SELECT 1 FROM embeddings WHERE key = ?", (key,)).fetchone():
+                        continue
+                    dim = len(embedding)
+                    slot = self.allocate_slot(dim)
+                    self.vector_file(dim, slot + 1)[slot] = embedding
+                    self.conn.execute("INSERT INTO embeddings VALUES (?, ?, ?, ?)", (key, dim, slot, now))
+                self.evict()
+                # Vectors reach the file before the index rows pointing at them are committed, so a
+                # crash in between cannot leave entries that return unwritten (zero) vectors.
+                for vectors in self.vectors.values():
+                    vectors.flush()
+
+    def allocate_slot(self, dim):
+        row = self.conn.execute("SELECT slot FROM free_slots WHERE dim = ? ORDER BY slot LIMIT 1", (dim,)).fetchone()
+        if row:
+            self.conn.execute("DELETE FROM free_slots WHERE dim = ? AND slot = ?", (dim, row[0]))
+            return row[0]
+        row = self.conn.execute("SELECT allocated FROM slot_counts WHERE dim = ?", (dim,)).fetchone()
+        slot = row[0] if row else 0
+        self.conn.execute("INSERT OR REPLACE INTO slot_counts VALUES (?, ?)", (dim, slot + 1))
+        return slot
+
+    def stored_bytes(self):
+        row = self.conn.execute("SELECT COALESCE(SUM(dim), 0) FROM embeddings").fetchone()
+        return row[0] * np.dtype(np.float32).itemsize
+
+    def evict(self):
+        """Drop least recently used entries until the stored vectors fit in max_bytes."""
+        excess = self.stored_bytes() - self.max_bytes
+        if excess <= 0:
+            return
+        victims = []
+        for key, dim, slot in self.conn.execute("SELECT key, dim, slot FROM embeddings ORDER BY last_used"):
+            victims.append((key, dim, slot))
+            excess -= dim * np.dtype(np.float32).itemsize
+            if excess <= 0:
+                break
+        self.conn.executemany("DELETE FROM embeddings WHERE key = ?", [(key,) for key, _, _ in victims])
+        self.conn.executemany("INSERT INTO free_slots VALUES (?, ?)", [(dim, slot) for _, dim, slot in victims])
+        self.evictions += len(victims)
+
+    def stats(self):
+        """Return this object's hit/miss/eviction counters and the number of cached entries."""
+        with self.lock:
+            entries = self.conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": entries
+        }
+
+    def close(self):
+        with self.lock:
+            for vectors in self.vectors.values():
+                vectors.flush()
+            self.vectors.clear()
+            self.conn.close()
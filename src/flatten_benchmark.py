@@ -0,0 +1,217 @@
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from flattened_json import (
+    flatten_json,
+    extract_all_gpt_4o,
+    iter_flattened_responses,
+    iter_flatten_json_template,
+    response_keys_for_model
+)
+
+##############################
+# Synthetic Response Generators
+##############################
+
+FIELD_NAMES = ["case_number", "officer", "badge", "incident_date", "location", "narrative",
+               "witnesses", "charges", "vehicle", "disposition", "", "a.b", "items[0]"]
+
+def make_nested_response(rng, depth, breadth, leaf_length=20):
+    """
+    Build a random nested LLM-style response: dicts and lists down to the given depth,
+    with scalar leaves (strings, numbers, booleans, None) and the odd empty container.
+    Field names include "" and names containing "." or "[0]" so key-path collisions occur.
+    """
+    if depth == 0 or rng.random() < 0.15:
+        return rng.choice([
+            "x" * rng.randint(0, leaf_length), rng.randint(-10, 1000), rng.random(), True, None, {}, []
+        ])
+    if rng.random() < 0.6:
+        return {rng.choice(FIELD_NAMES): make_nested_response(rng, depth - 1, breadth, leaf_length)
+                for _ in range(rng.randint(1, breadth))}
+    return [make_nested_response(rng, depth - 1, breadth, leaf_length) for _ in range(rng.randint(0, breadth))]
+
+def make_template_output(rng, num_pages, response_depth=4, response_breadth=4, page_text_length=2000,
+                         response_key="gpt_4o_response"):
+    """
+    Build a template output shaped like structured_extraction_template_*: mostly page text and
+    metadata, with one small response per page stored under response_key.
+    """
+    return {
+        "file": "synthetic.pdf",
+        "pages": [
+            {
+                "page_no": page,
+                "text": "x" * page_text_length,
+                "metadata": {"width": 612, "height": 792, "items": [{"bbox": [1, 2, 3, 4]}] * 10},
+                response_key: make_nested_response(rng, response_depth, response_breadth)
+            }
+            for page in range(1, num_pages + 1)
+        ]
+    }
+
+def make_deep_response(depth):
+    """Build a response nested depth levels deep, alternating dicts and lists."""
+    data = "leaf"
+    for level in range(depth):
+        data = {f"level{level}": data} if level % 2 else [data]
+    return data
+
+##############################
+# Reference Implementations
+##############################
+
+def legacy_extract_and_flatten(data):
+    """Two-pass extract-then-flatten that iter_flattened_responses replaced; kept as the reference result."""
+    return [legacy_flatten_json(response) for response in extract_all_gpt_4o(data)]
+
+def legacy_flatten_json(data, parent_key='', sep='.'):
+    """Recursive flattener that flatten_json replaced; kept as the reference result."""
+    items = {}
+    if isinstance(data, dict):
+        for k, v in data.items():
+            new_key = f"{parent_key}{sep}{k}" if parent_key else k
+            items.update(legacy_flatten_json(v, new_key, sep=sep))
+    elif isinstance(data, list):
+        for i, v in enumerate(data):
+            new_key = f"{parent_key}[{i}]"
+            items.update(legacy_flatten_json(v, new_key, sep=sep))
+    else:
+        items[parent_key] = data
+    return items
+
+##############################
+# Equivalence Checks
+##############################
+
+def check_flatten_json(num_seeds=500):
+    """Compare flatten_json with the recursive reference, including key order, on random responses."""
+    for seed in range(num_seeds):
+        rng = random.Random(seed)
+        data = make_nested_response(rng, depth=rng.randint(0, 7), breadth=4)
+        for parent_key, sep in (('', '.'), ('root', '.'), ('', '/')):
+            expected = legacy_flatten_json(data, parent_key, sep)
+            actual = flatten_json(data, parent_key, sep)
+            assert list(actual.items()) == list(expected.items()), \
+                f"flatten_json disagrees with the recursive reference (seed={seed})"
+    print(f"flatten_json: matches the recursive reference on {num_seeds} responses")
+
+def check_iter_flattened_responses(num_seeds=200):
+    """Compare the single-pass extractor-flattener with extract_all_gpt_4o + flatten on random documents."""
+    keys = response_keys_for_model("gpt_4o")
+    for seed in range(num_seeds):
+        rng = random.Random(seed)
+        data = make_template_output(rng, rng.randint(0, 5), response_depth=rng.randint(0, 5))
+        # Nest a second response inside a response; it must not be extracted separately.
+        data["pages"].append({"gpt_4o_response": {"inner": {"gpt_4o_response": seed}}})
+        expected = legacy_extract_and_flatten(data)
+        actual = list(iter_flattened_responses(data, keys))
+        assert actual == expected, f"iter_flattened_responses disagrees with the reference (seed={seed})"
+    print(f"iter_flattened_responses: matches extract-then-flatten on {num_seeds} documents")
+
+def check_lazy_flatten(num_seeds=100):
+    """Compare lazy (ijson) and eager (json.load) flattening of random template files."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "template.json")
+        for seed in range(num_seeds):
+            rng = random.Random(seed)
+            data = make_template_output(rng, rng.randint(0, 5), response_depth=rng.randint(0, 5))
+            data["pages"].append({"gpt_4o_response": {"inner": {"gpt_4o_response": seed}}})
+            with open(path, "w") as f:
+                json.dump(data, f, indent=4)
+            expected = list(iter_flatten_json_template(path))
+            actual = list(iter_flatten_json_template(path, lazy=True))
+            assert actual == expected, f"lazy flattening disagrees with json.load (seed={seed})"
+    print(f"lazy flattening: matches json.load on {num_seeds} template files")
+
+##############################
+# Benchmarks
+##############################
+
+def time_call(func, *args, repeat=5):
+    """Return (best wall time in seconds, result of the last call)."""
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def benchmark_flatten_json(depth, breadth, seed=0):
+    """Compare the recursive and iterative flatteners on one large nested response."""
+    data = make_nested_response(random.Random(seed), depth, breadth)
+    legacy_time, legacy_result = time_call(legacy_flatten_json, data)
+    new_time, new_result = time_call(flatten_json, data)
+    assert legacy_result == new_result, "flatten_json disagrees with the recursive reference"
+    print(f"flatten_json: depth {depth}, breadth {breadth} ({len(new_result)} leaves)")
+    print(f"  recursive:    {legacy_time * 1000:8.2f} ms")
+    print(f"  flatten_json: {new_time * 1000:8.2f} ms  ({legacy_time / new_time:.1f}x)")
+
+def benchmark_extract_and_flatten(num_pages, seed=0):
+    """Compare two-pass extract-then-flatten with the single-pass iter_flattened_responses."""
+    data = make_template_output(random.Random(seed), num_pages)
+    keys = response_keys_for_model("gpt_4o")
+    legacy_time, legacy_result = time_call(legacy_extract_and_flatten, data)
+    new_time, new_result = time_call(lambda d: list(iter_flattened_responses(d, keys)), data)
+    assert legacy_result == new_result, "iter_flattened_responses disagrees with the reference"
+    print(f"extract and flatten: template output with {num_pages} pages")
+    print(f"  extract then flatten:     {legacy_time * 1000:8.2f} ms")
+    print(f"  iter_flattened_responses: {new_time * 1000:8.2f} ms  ({legacy_time / new_time:.1f}x)")
+
+def measure_flatten_template(path, lazy):
+    """Flatten one template file, returning (seconds, peak traced bytes, number of records)."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    num_records = sum(1 for _ in iter_flatten_json_template(path, lazy=lazy))
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak, num_records
+
+def benchmark_lazy_flatten(num_pages, page_text_length=20000, seed=0):
+    """Compare eager and lazy parsing of a large template file made mostly of page text."""
+    data = make_template_output(random.Random(seed), num_pages, page_text_length=page_text_length)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "template.json")
+        with open(path, "w") as f:
+            json.dump(data, f, indent=4)
+        size = os.path.getsize(path)
+        eager_time, eager_peak, num_records = measure_flatten_template(path, lazy=False)
+        lazy_time, lazy_peak, _ = measure_flatten_template(path, lazy=True)
+    print(f"lazy flattening: {num_pages} pages, {size / 1e6:.1f} MB, {num_records} records")
+    print(f"  json.load: {eager_time * 1000:8.2f} ms, peak {eager_peak / 1e6:8.2f} MB")
+    print(f"  ijson:     {lazy_time * 1000:8.2f} ms, peak {lazy_peak / 1e6:8.2f} MB")
+
+def benchmark_deep_nesting(depth):
+    """Show that flatten_json handles nesting deeper than the recursion limit."""
+    data = make_deep_response(depth)
+    try:
+        legacy_flatten_json(data)
+        legacy_status = "ok"
+    except RecursionError:
+        legacy_status = "RecursionError"
+    new_time, new_result = time_call(flatten_json, data, repeat=1)
+    print(f"flatten_json: {depth} levels deep (recursion limit {sys.getrecursionlimit()})")
+    print(f"  recursive:    {legacy_status}")
+    print(f"  flatten_json: {new_time * 1000:8.2f} ms, {len(new_result)} leaf")
+
+###################################
+# Main Entry Point
+###################################
+
+if __name__ == "__main__":
+    check_flatten_json()
+    benchmark_flatten_json(depth=6, breadth=6)
+    benchmark_flatten_json(depth=10, breadth=4)
+    benchmark_flatten_json(depth=8, breadth=10)
+    benchmark_deep_nesting(depth=5000)
+    check_iter_flattened_responses()
+    benchmark_extract_and_flatten(num_pages=500)
+    check_lazy_flatten()
+    benchmark_lazy_flatten(num_pages=2000)
@@ -2,19 +2,49 @@ import os
 import json
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
+import result_store
+
+try:
+    import ijson
+except ImportError:  # Only needed for lazy=True
+    ijson = None
+
+try:
+    import columnar_flattened
+except ImportError:  # Only needed for output_format="parquet" or "arrow" (requires pyarrow)
+    columnar_flattened = None
+
 def flatten_json(data, parent_key='', sep='.'):
-    """Recursively flattens a nested JSON object using dot notation."""
+    """
+    Flattens a nested JSON object using dot notation.
+    Walks the object with an explicit stack of child iterators (no recursion-depth limit),
+    writing every leaf straight into a single output dict; each key path is built once from
+    its parent's prefix.
+    """
     items = {}
     if isinstance(data, dict):
-        for k, v in data.items():
-            new_key = f"{parent_key}{sep}{k}" if parent_key else k
-            items.update(flatten_json(v, new_key, sep=sep))
+        stack = [(parent_key, iter(data.items()), True)]
     elif isinstance(data, list):
-        for i, v in enumerate(data):
-            new_key = f"{parent_key}[{i}]"
-            items.update(flatten_json(v, new_key, sep=sep))
+        stack = [(parent_key, enumerate(data), False)]
     else:
         items[parent_key] = data
+        return items
+    while stack:
+        prefix, children, is_dict = stack[-1]
+        for k, v in children:
+            if is_dict:
+                new_key = f"{prefix}{sep}{k}" if prefix else k
+            else:
+                new_key = f"{prefix}[{k}]"
+            if isinstance(v, dict):
+                stack.append((new_key, iter(v.items()), True))
+                break
+            elif isinstance(v, list):
+                stack.append((new_key, enumerate(v), False))
+                break
+            items[new_key] = v
+        else:
+            stack.pop()
     return items
 
 def extract_all_gpt_4o(data):
@@ -34,49 +64,164 @@ def extract_all_gpt_4o(data):
             responses.extend(extract_all_gpt_4o(item))
     return responses
 
-def flatten_json_template(full_gpt_response_path, model_name="gpt_4o"):
+def response_keys_for_model(model_name):
+    """
+    Return the set of template keys holding a model's responses: "<model_name>_response"
+    (e.g. "gpt_4o" -> "gpt_4o_response", "gpt_o1_mini" -> "gpt_o1_mini_response",
+    "gemini_2_flash" -> "gemini_2_flash_response"). model_name may also be a list of names.
+    """
+    if isinstance(model_name, str):
+        model_name = [model_name]
+    return {f"{name}_response" for name in model_name}
+
+def iter_flattened_responses(data, response_keys):
+    """
+    Yield the flattened form of every value found under any key in response_keys, in the
+    order extract_all_gpt_4o would find them.
+    The document is walked once with an explicit stack; response subtrees are not descended
+    into by the search, only by flatten_json, so every node is visited a single time.
+    """
+    if isinstance(data, dict):
+        stack = [(iter(data.items()), True)]
+    elif isinstance(data, list):
+        stack = [(iter(data), False)]
+    else:
+        return
+    while stack:
+        children, is_dict = stack[-1]
+        for child in children:
+            if is_dict:
+                k, v = child
+                if k in response_keys:
+                    yield flatten_json(v)
+                    continue
+            else:
+                v = child
+            if isinstance(v, dict):
+                stack.append((iter(v.items()), True))
+                break
+            elif isinstance(v, list):
+                stack.append((iter(v), False))
+                break
+        else:
+            stack.pop()
+
+def iter_lazy_responses(infile, response_keys):
+    """
+    Parse a binary JSON file incrementally with ijson and yield every value found under any key
+    in response_keys, in document order.
+    Only those subtrees are built into Python objects; the page text and metadata around them
+    are tokenized and dropped, so memory stays proportional to the largest response.
+    As in iter_flattened_responses, responses nested inside a response are not yielded separately.
+    """
+    if ijson is None:
+        raise ImportError("Lazy mode requires the ijson package (pip install ijson).")
+    events = ijson.parse(infile, use_float=True)
+    for _, event, value in events:
+        if event != "map_key" or value not in response_keys:
+            continue
+        builder = ijson.ObjectBuilder()
+        depth = 0
+        for _, event, value in events:
+            builder.event(event, value)
+            if event == "start_map" or event == "start_array":
+                depth += 1
+            elif event == "end_map" or event == "end_array":
+                depth -= 1
+            if depth == 0:
+                break
+        yield builder.value
+
+def iter_flatten_json_template(full_gpt_response_path, model_name="gpt_4o", lazy=False):
     """
-    Loads the JSON from the given file, extracts all 'gpt_4o_response' objects,
-    flattens each one, and returns a list of flattened dictionaries.
-    The model_name parameter is kept for compatibility.
+    Loads the JSON from the given file and lazily yields the flattened form of every
+    response stored under the model's response key(s) (see response_keys_for_model).
+    With lazy=True the file is parsed incrementally and only the response subtrees are
+    materialized (see iter_lazy_responses).
     """
+    response_keys = response_keys_for_model(model_name)
+    if lazy:
+        with open(full_gpt_response_path, "rb") as infile:
+            for response in iter_lazy_responses(infile, response_keys):
+                yield flatten_json(response)
+        return
     with open(full_gpt_response_path, "r") as infile:
         data = json.load(infile)
-    
-    # Extract all objects under "gpt_4o_response"
-    responses = extract_all_gpt_4o(data)
-    
-    # Flatten each extracted response
-    flattened_responses = [flatten_json(response) for response in responses]
-    return flattened_responses
+    yield from iter_flattened_responses(data, response_keys)
+
+def flatten_json_template(full_gpt_response_path, model_name="gpt_4o", lazy=False):
+    """
+    Loads the JSON from the given file, extracts all '<model_name>_response' objects
+    ('gpt_4o_response' by default), flattens each one, and returns a list of flattened dictionaries.
+    """
+    return list(iter_flatten_json_template(full_gpt_response_path, model_name, lazy))
+
+def write_flattened_json(records, output_path):
+    """
+    Write flattened records as a JSON array as they are produced; the bytes are identical
+    to json.dump(list(records), f, indent=4).
+    """
+    with open(output_path, "w") as outfile:
+        outfile.write("[")
+        first = True
+        for record in records:
+            # JSON strings never contain raw newlines, so re-indenting line by line is safe.
+            outfile.write(("\n    " if first else ",\n    ") + json.dumps(record, indent=4).replace("\n", "\n    "))
+            first = False
+        outfile.write("]" if first else "\n]")
 
 ###################################
 # Multi-File Processing Functions
 ###################################
 
-def process_single_file(sub_dir, file, input_extraction_dir, output_flattened_dir, model_name="gpt_4o"):
+def process_single_file(sub_dir, file, input_extraction_dir, output_flattened_dir, model_name="gpt_4o",
+                        result_store_path=None, lazy=False, output_format="json"):
     """
     Process a single file.
-    Build the full path to the input file, extract and flatten all "gpt_4o_response" objects,
-    and save the flattened output as a JSON file.
+    Build the full path to the input file, extract and flatten all "<model_name>_response" objects,
+    and save the flattened output as a JSON file, or into the SQLite result store at
+    result_store_path when one is given. Records are written as they are flattened; the
+    previous output is only replaced once the whole file has been flattened.
+    With lazy=True only the response subtrees of the input are parsed into Python objects.
+    output_format "parquet" or "arrow" writes a dictionary-encoded columnar file instead of JSON
+    (see columnar_flattened).
     """
+    if output_format != "json" and columnar_flattened is None:
+        raise ImportError("Columnar output requires the pyarrow package (pip install pyarrow).")
     full_gpt_response_path = os.path.join(input_extraction_dir, sub_dir, file)
    
-    combined_data = flatten_json_template(full_gpt_response_path, model_name)
+    combined_data = iter_flatten_json_template(full_gpt_response_path, model_name, lazy)
+    
+    if result_store_path:
+        doc_key = result_store.document_key(sub_dir, file)
+        result_store.write_flattened_document(result_store.get_result_store(result_store_path), doc_key, combined_data)
+        print(f"Processed file. Output saved to {result_store_path} as {doc_key}")
+        return
     
     base_filename = os.path.splitext(file)[0]
     output_subdir = os.path.join(output_flattened_dir, sub_dir, base_filename)
     os.makedirs(output_subdir, exist_ok=True)
     
-    output_path = os.path.join(output_subdir, "flattened_structured_data.json")
-    with open(output_path, "w") as outfile:
-        json.dump(combined_data, outfile, indent=4)
+    if output_format == "json":
+        output_path = os.path.join(output_subdir, "flattened_structured_data.json")
+        # Records are flattened while writing, so write to a temporary file: an input that
+        # fails to parse midway must not leave a truncated output behind (or replace a good one).
+        partial_path = output_path + ".partial"
+        write_flattened_json(combined_data, partial_path)
+        os.replace(partial_path, output_path)
+    else:
+        output_path = os.path.join(output_subdir, columnar_flattened.FLATTENED_COLUMNAR_FILENAMES[output_format])
+        columnar_flattened.write_flattened_columnar(combined_data, output_path)
     
     print(f"Processed file. Output saved to {output_path}")
 
-def process_structured_extraction_directories(input_extraction_dir, output_flattened_dir, model_name="gpt_4o"):
+def process_structured_extraction_directories(input_extraction_dir, output_flattened_dir, model_name="gpt_4o",
+                                              result_store_path=None, lazy=False, output_format="json"):
     """
     Walk through the input extraction directory and process each JSON file concurrently.
+    With result_store_path set, flattened records are written to that SQLite result store.
+    With lazy=True inputs are parsed incrementally (requires ijson).
+    output_format is "json" (default), "parquet" or "arrow".
     """
     tasks = []
     with ThreadPoolExecutor(max_workers=5) as executor:
@@ -88,7 +233,7 @@ def process_structured_extraction_directories(input_extraction_dir, output_flatt
                         executor.submit(
                             process_single_file, sub_dir, file,
                             input_extraction_dir, output_flattened_dir,
-                            model_name
+                            model_name, result_store_path, lazy, output_format
                         )
                     )
         for future in as_completed(tasks):
@@ -0,0 +1,176 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Responses of LLM calls, keyed by a hash of everything that determines the answer
+# (model, messages, response_format and any other request parameters).
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    model TEXT,
+    response TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used);
+"""
+
+DEFAULT_MAX_BYTES = 512 * 1024 ** 2
+
+# Set LLM_RESPONSE_CACHE to a file path to cache the llm_models wrappers' responses there;
+# LLM_RESPONSE_CACHE_TTL sets the time to live in seconds (default: no expiry).
+CACHE_PATH_ENV = "LLM_RESPONSE_CACHE"
+CACHE_TTL_ENV = "LLM_RESPONSE_CACHE_TTL"
+
+_default_caches = {}
+_default_caches_lock = threading.Lock()
+
+def request_key(model, messages=None, response_format=None, **params):
+    """Return the cache key of a request: sha256 of its canonical JSON form."""
+    request = {"model": model, "messages": messages, "response_format": response_format, **params}
+    return hashlib.sha256(json.dumps(request, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    """
+    Persistent LLM response cache in a SQLite file, shared by the threads of one process.
+
+    Entries older than ttl seconds are treated as misses and removed (ttl=None: never expire).
+    When the stored responses exceed max_bytes, the least recently used ones are evicted.
+    hits, misses, expired and evictions count what happened through this object.
+    """
+    def __init__(self, path, ttl=None, max_bytes=DEFAULT_MAX_BYTES):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=60.0, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Return the cached response text for key, or None on a miss."""
+        with self.lock:
+            row = self.conn.execute("SELECT response, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            now = time.time()
+            if row is not None and self.ttl is not None and now - row[1] > self.ttl:
+                with self.conn:
+                    self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.expired += 1
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            with self.conn:
+                self.conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, response, model=None):
+        """Store (or refresh) the response text for key, then evict down to max_bytes."""
+        size = len(response.encode("utf-8"))
+        with self.lock:
+            now = time.time()
+            with self.conn:
+                self.conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                                  (key, model, response, size, now, now))
+                self.evict()
+
+    def evict(self):
+        """Drop least recently used responses until the rest fit in max_bytes."""
+        excess = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0] - self.max_bytes
+        if excess <= 0:
+            return
+        victims = []
+        for key, size in self.conn.execute("SELECT key, size FROM responses ORDER BY last_used"):
+            victims.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        self.conn.executemany("DELETE FROM responses WHERE key = ?", victims)
+        self.evictions += len(victims)
+
+    def stats(self):
+        """Return this object's hit/miss counters and the number of cached responses."""
+        with self.lock:
+            entries = self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "expired": self.expired,
+            "evictions": self.evictions,
+            "entries": entries
+        }
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+def cached_response(cache, key, call, model=None, bypass=False, cacheable=None):
+    """
+    Return call()'s response text through cache: a hit skips the call; a miss (or bypass=True,
+    which always calls and refreshes the entry) stores the new response, unless
+    cacheable(response) is false. cache may be None.
+    """
+    if cache is not None and not bypass:
+        response = cache.get(key)
+        if response is not None:
+            return response
+    response = call()
+    if cache is not None and response is not None and (cacheable is None or cacheable(response)):
+        cache.put(key, response, model)
+    return response
+
+def is_valid_json(raw_response):
+    """Only responses that parse are cached, so a bad answer is asked again next run."""
+    try:
+        json.loads(raw_response)
+        return True
+    except Exception:
+        return False
+
+def response_text(response):
+    """Return the text of an OpenAI-style chat completion, of a response with .text (e.g. Gemini), or text itself."""
+    if isinstance(response, str):
+        return response
+    if hasattr(response, "choices"):
+        return response.choices[0].message.content
+    return response.text
+
+def cached_completion(create, request, bypass=False, cacheable=None):
+    """
+    Return the response text of create(**request) through the process-wide cache named by
+    $LLM_RESPONSE_CACHE (see default_response_cache; uncached when it is not set).
+    bypass=True always calls create and refreshes the cached response. Responses to a
+    json_object request are cached only when they parse, unless cacheable says otherwise.
+    This is how the llm_models wrappers call their APIs when src/ is on the import path.
+    """
+    if cacheable is None and (request.get("response_format") or {}).get("type") == "json_object":
+        cacheable = is_valid_json
+    return cached_response(default_response_cache(), request_key(**request),
+                           lambda: response_text(create(**request)), model=request.get("model"), bypass=bypass,
+                           cacheable=cacheable)
+
+def default_response_cache():
+    """Return the process-wide cache named by $LLM_RESPONSE_CACHE, or None when it is not set."""
+    path = os.getenv(CACHE_PATH_ENV)
+    if not path:
+        return None
+    with _default_caches_lock:
+        if path not in _default_caches:
+            ttl = os.getenv(CACHE_TTL_ENV)
+            _default_caches[path] = ResponseCache(path, ttl=float(ttl) if ttl else None)
+        return _default_caches[path]
@@ -0,0 +1,277 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# One SQLite file holds the outputs of a whole corpus instead of one directory per document.
+# Documents are keyed by (stage, doc_key), where doc_key is the relative output path the
+# directory layout would have used (e.g. "sub_dir/base_filename").
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    id INTEGER PRIMARY KEY,
+    stage TEXT NOT NULL,
+    doc_key TEXT NOT NULL,
+    status TEXT NOT NULL,
+    manifest TEXT,
+    metrics TEXT,
+    updated_at REAL NOT NULL,
+    UNIQUE (stage, doc_key)
+);
+CREATE TABLE IF NOT EXISTS pages (
+    document_id INTEGER NOT NULL REFERENCES documents(id) ON DELETE CASCADE,
+    page_no INTEGER NOT NULL,
+    item_count INTEGER NOT NULL,
+    PRIMARY KEY (document_id, page_no)
+);
+CREATE TABLE IF NOT EXISTS items (
+    document_id INTEGER NOT NULL REFERENCES documents(id) ON DELETE CASCADE,
+    page_no INTEGER NOT NULL,
+    item_index INTEGER NOT NULL,
+    type TEXT,
+    content TEXT,
+    k_lines TEXT,
+    bbox TEXT,
+    PRIMARY KEY (document_id, page_no, item_index)
+);
+CREATE TABLE IF NOT EXISTS records (
+    document_id INTEGER NOT NULL REFERENCES documents(id) ON DELETE CASCADE,
+    record_index INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (document_id, record_index)
+);
+"""
+
+COMBINED_STAGE = "combined"
+FLATTENED_STAGE = "flattened"
+
+# A new version of a document is written under doc_key + STAGING_SUFFIX (a key no input path can
+# produce) and only swapped in for the previous version once it is complete.
+STAGING_SUFFIX = "\0staging"
+
+_local = threading.local()
+
+##############################
+# Connections
+##############################
+
+def connect_result_store(path, timeout=60.0):
+    """
+    Open (and if needed create) a result store in WAL mode, so readers never block the writer
+    and several worker processes can take turns writing.
+    """
+    conn = sqlite3.connect(path, timeout=timeout)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA foreign_keys=ON")
+    conn.executescript(SCHEMA)
+    if "metrics" not in {row[1] for row in conn.execute("PRAGMA table_info(documents)")}:
+        # Stores created before metrics were kept with their documents.
+        try:
+            with conn:
+                conn.execute("ALTER TABLE documents ADD COLUMN metrics TEXT")
+        except sqlite3.OperationalError:
+            pass  # Another process added it first
+    return conn
+
+def get_result_store(path):
+    """Return a connection to path that is cached per thread (and therefore per worker process)."""
+    connections = getattr(_local, "connections", None)
+    if connections is None:
+        connections = _local.connections = {}
+    if path not in connections:
+        connections[path] = connect_result_store(path)
+    return connections[path]
+
+def document_key(sub_dir, file):
+    """Return the doc_key for an input file, matching the per-document output directory layout."""
+    return os.path.normpath(os.path.join(sub_dir, os.path.splitext(file)[0]))
+
+##############################
+# Documents
+##############################
+
+def reset_document(conn, stage, doc_key):
+    """
+    Create or reset a document, mark it as being written, and return its id, inside the
+    caller's transaction (begin_document commits it on its own).
+    """
+    conn.execute(
+        "INSERT INTO documents (stage, doc_key, status, updated_at) VALUES (?, ?, 'writing', ?) "
+        "ON CONFLICT (stage, doc_key) DO UPDATE SET status = 'writing', manifest = NULL, metrics = NULL, "
+        "updated_at = excluded.updated_at",
+        (stage, doc_key, time.time())
+    )
+    document_id = conn.execute(
+        "SELECT id FROM documents WHERE stage = ? AND doc_key = ?", (stage, doc_key)
+    ).fetchone()[0]
+    for table in ("pages", "items", "records"):
+        conn.execute(f"DELETE FROM {table} WHERE document_id = ?", (document_id,))
+    return document_id
+
+def delete_document(conn, stage, doc_key):
+    """Delete a document and its rows, inside the caller's transaction."""
+    row = conn.execute("SELECT id FROM documents WHERE stage = ? AND doc_key = ?", (stage, doc_key)).fetchone()
+    if row is None:
+        return
+    for table in ("pages", "items", "records"):
+        conn.execute(f"DELETE FROM {table} WHERE document_id = ?", (row[0],))
+    conn.execute("DELETE FROM documents WHERE id = ?", (row[0],))
+
+def begin_document(conn, stage, doc_key):
+    """
+    Start writing a new version of a document and return the id to write its rows under.
+    The rows go to a staging document (replacing any left behind by a failed run), so the
+    previous complete version stays readable until finish_document swaps the new one in.
+    """
+    with conn:
+        return reset_document(conn, stage, doc_key + STAGING_SUFFIX)
+
+def finish_document(conn, document_id, manifest=None):
+    """
+    Swap a document started with begin_document in for its previous version, in one transaction,
+    and mark it complete; readers only ever see complete documents.
+    """
+    with conn:
+        stage, staging_key = conn.execute(
+            "SELECT stage, doc_key FROM documents WHERE id = ?", (document_id,)
+        ).fetchone()
+        doc_key = staging_key[:-len(STAGING_SUFFIX)]
+        delete_document(conn, stage, doc_key)
+        conn.execute(
+            "UPDATE documents SET doc_key = ?, status = 'complete', manifest = ?, updated_at = ? WHERE id = ?",
+            (doc_key, json.dumps(manifest) if manifest is not None else None, time.time(), document_id)
+        )
+
+def get_document_manifest(conn, stage, doc_key):
+    """Return the manifest stored with a complete document, or None."""
+    row = conn.execute(
+        "SELECT manifest FROM documents WHERE stage = ? AND doc_key = ? AND status = 'complete'",
+        (stage, doc_key)
+    ).fetchone()
+    return json.loads(row[0]) if row and row[0] else None
+
+def set_document_manifest(conn, stage, doc_key, manifest):
+    """Replace the manifest stored with a document (used when an incremental check refreshes mtimes)."""
+    with conn:
+        conn.execute(
+            "UPDATE documents SET manifest = ? WHERE stage = ? AND doc_key = ?",
+            (json.dumps(manifest), stage, doc_key)
+        )
+
+def set_document_metrics(conn, stage, doc_key, metrics):
+    """Store the per-document metrics record (what the metrics sidecar holds in directory mode)."""
+    with conn:
+        conn.execute(
+            "UPDATE documents SET metrics = ? WHERE stage = ? AND doc_key = ?",
+            (json.dumps(metrics), stage, doc_key)
+        )
+
+def get_document_metrics(conn, stage, doc_key):
+    """Return the metrics record stored with a complete document, or None."""
+    row = conn.execute(
+        "SELECT metrics FROM documents WHERE stage = ? AND doc_key = ? AND status = 'complete'",
+        (stage, doc_key)
+    ).fetchone()
+    return json.loads(row[0]) if row and row[0] else None
+
+def list_documents(conn, stage):
+    """Return the doc_keys of all complete documents of a stage, in key order."""
+    rows = conn.execute(
+        "SELECT doc_key FROM documents WHERE stage = ? AND status = 'complete' ORDER BY doc_key", (stage,)
+    )
+    return [row[0] for row in rows]
+
+##############################
+# Combined Structured Data
+##############################
+
+def write_combined_document(conn, doc_key, pages, manifest=None, batch_size=1000):
+    """
+    Store (page, combined_items) pairs for one document.
+    Rows are inserted in transactions of batch_size items as pages arrive, so the write lock
+    is never held while a page is being combined. They are staged (see begin_document): the
+    new version replaces the previous one only once the last batch is committed, so a run that
+    fails midway leaves the previous complete version in place.
+    """
+    document_id = begin_document(conn, COMBINED_STAGE, doc_key)
+    page_rows, item_rows = [], []
+
+    def flush():
+        with conn:
+            conn.executemany("INSERT INTO pages VALUES (?, ?, ?)", page_rows)
+            conn.executemany("INSERT INTO items VALUES (?, ?, ?, ?, ?, ?, ?)", item_rows)
+        page_rows.clear()
+        item_rows.clear()
+
+    for page, items in pages:
+        page_rows.append((document_id, page, len(items)))
+        for index, item in enumerate(items):
+            item_rows.append((document_id, page, index, item["type"], item["content"],
+                              item["k-lines"], json.dumps(item["bbox"])))
+        if len(item_rows) >= batch_size:
+            flush()
+    flush()
+    finish_document(conn, document_id, manifest)
+
+def read_combined_document(conn, doc_key):
+    """
+    Return a stored document as {page_no: [items]}, the same shape combine_all_json_files returns.
+    Raises KeyError if the document is missing or incomplete.
+    """
+    row = conn.execute(
+        "SELECT id FROM documents WHERE stage = ? AND doc_key = ? AND status = 'complete'",
+        (COMBINED_STAGE, doc_key)
+    ).fetchone()
+    if row is None:
+        raise KeyError(doc_key)
+    combined = {page: [] for (page,) in conn.execute(
+        "SELECT page_no FROM pages WHERE document_id = ? ORDER BY page_no", (row[0],)
+    )}
+    for page, item_type, content, k_lines, bbox in conn.execute(
+        "SELECT page_no, type, content, k_lines, bbox FROM items WHERE document_id = ? "
+        "ORDER BY page_no, item_index", (row[0],)
+    ):
+        combined[page].append({
+            "page_no": page,
+            "k-lines": k_lines,
+            "type": item_type,
+            "content": content,
+            "bbox": [tuple(pt) for pt in json.loads(bbox)]
+        })
+    return combined
+
+##############################
+# Flattened Records
+##############################
+
+def write_flattened_document(conn, doc_key, records, batch_size=1000):
+    """
+    Store the flattened records of one document, in transactions of batch_size records as they
+    arrive, so the write lock is never held while the input is being parsed and flattened.
+    Like write_combined_document, the new version is staged and only replaces the previous one
+    once complete: if records raises (e.g. on a truncated input), the previous version is kept.
+    """
+    document_id = begin_document(conn, FLATTENED_STAGE, doc_key)
+    rows = []
+    for index, record in enumerate(records):
+        rows.append((document_id, index, json.dumps(record)))
+        if len(rows) >= batch_size:
+            with conn:
+                conn.executemany("INSERT INTO records VALUES (?, ?, ?)", rows)
+            rows.clear()
+    with conn:
+        conn.executemany("INSERT INTO records VALUES (?, ?, ?)", rows)
+    finish_document(conn, document_id)
+
+def read_flattened_document(conn, doc_key):
+    """Return the flattened records of a stored document. Raises KeyError if it is missing or incomplete."""
+    row = conn.execute(
+        "SELECT id FROM documents WHERE stage = ? AND doc_key = ? AND status = 'complete'",
+        (FLATTENED_STAGE, doc_key)
+    ).fetchone()
+    if row is None:
+        raise KeyError(doc_key)
+    return [json.loads(data) for (data,) in conn.execute(
+        "SELECT data FROM records WHERE document_id = ? ORDER BY record_index", (row[0],)
+    )]
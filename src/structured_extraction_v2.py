@@ -1,8 +1,93 @@
 import os
 import json
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import hashlib
+import time
+import traceback
+from bisect import bisect_right
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import numpy as np
 from shapely.geometry import Polygon
 
+import result_store
+
+try:
+    import ijson
+except ImportError:  # Only needed for streaming=True
+    ijson = None
+
+try:
+    import orjson
+except ImportError:  # compact=True falls back to the json module
+    orjson = None
+
+##########################
+# Instrumentation
+##########################
+
+class StageMetrics:
+    """
+    Accumulates wall time and item counters per pipeline stage for one document.
+    Stages may nest (e.g. page combining runs inside the streaming write); each stage is
+    charged only its own time, so the stage times add up to the instrumented wall time.
+    """
+    def __init__(self):
+        self.seconds = {}
+        self.counters = {}
+        self._open_stages = []
+
+    @contextmanager
+    def stage(self, name):
+        child_time = [0.0]
+        self._open_stages.append(child_time)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self._open_stages.pop()
+            self.seconds[name] = self.seconds.get(name, 0.0) + elapsed - child_time[0]
+            if self._open_stages:
+                self._open_stages[-1][0] += elapsed
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def to_dict(self):
+        return {"seconds": dict(self.seconds), "counters": dict(self.counters)}
+
+class NullMetrics:
+    """Stand-in used when instrumentation is off; every call is a no-op."""
+    def stage(self, name):
+        return nullcontext()
+
+    def count(self, name, n=1):
+        pass
+
+NO_METRICS = NullMetrics()
+
+def aggregate_metrics(metrics_dicts):
+    """
+    Sum per-document StageMetrics.to_dict() results into a directory-level summary,
+    including each stage's share of the total instrumented time.
+    """
+    seconds, counters = {}, {}
+    for metrics in metrics_dicts:
+        for name, value in metrics["seconds"].items():
+            seconds[name] = seconds.get(name, 0.0) + value
+        for name, value in metrics["counters"].items():
+            counters[name] = counters.get(name, 0) + value
+    total = sum(seconds.values())
+    return {
+        "files": len(metrics_dicts),
+        "total_seconds": total,
+        "seconds": dict(sorted(seconds.items(), key=lambda kv: kv[1], reverse=True)),
+        "share": {name: value / total for name, value in seconds.items()} if total else {},
+        "counters": counters
+    }
+
 ##########################
 # Standardization Helpers
 ##########################
@@ -21,11 +106,103 @@ def get_bottom(bbox):
     """Return the largest y coordinate from the bbox."""
     return max(pt[1] for pt in bbox)
 
+##########################
+# Containment Helpers
+##########################
+
+def bbox_extents(bboxes):
+    """
+    Return an (N, 4) array of [min_x, min_y, max_x, max_y] rows, one per bbox.
+    Empty bboxes get NaN extents so they never pass an extent comparison.
+    """
+    extents = np.full((len(bboxes), 4), np.nan)
+    for i, bbox in enumerate(bboxes):
+        if bbox:
+            xs = [pt[0] for pt in bbox]
+            ys = [pt[1] for pt in bbox]
+            extents[i] = (min(xs), min(ys), max(xs), max(ys))
+    return extents
+
+def find_contained_items(inner_items, outer_items):
+    """
+    Return a list of booleans, one per inner item, that is True when the item's bbox
+    is completely contained within the bbox of any outer item.
+    
+    The bbox extents of both sides are computed once per page and compared in a single
+    vectorized axis-aligned check. Only the (inner, outer) pairs that survive it get the
+    exact polygon test, and each polygon is built at most once.
+    """
+    contained = [False] * len(inner_items)
+    if not inner_items or not outer_items:
+        return contained
+    inner = bbox_extents([item['bbox'] for item in inner_items])
+    outer = bbox_extents([item['bbox'] for item in outer_items])
+    candidates = (
+        (inner[:, None, 0] >= outer[None, :, 0]) &
+        (inner[:, None, 1] >= outer[None, :, 1]) &
+        (inner[:, None, 2] <= outer[None, :, 2]) &
+        (inner[:, None, 3] <= outer[None, :, 3])
+    )
+    outer_polygons = {}
+    for i in np.flatnonzero(candidates.any(axis=1)):
+        inner_polygon = Polygon(inner_items[i]['bbox'])
+        for j in np.flatnonzero(candidates[i]):
+            if j not in outer_polygons:
+                outer_polygons[j] = Polygon(outer_items[j]['bbox'])
+            if inner_polygon.within(outer_polygons[j]):
+                contained[i] = True
+                break
+    return contained
+
+##########################
+# K-Line Helpers
+##########################
+
+def assign_k_lines(combined_data, page_lines):
+    """
+    Return one list of stripped line texts per item in combined_data (which must be sorted by top).
+    
+    Each line goes to the first item whose top is strictly below the line's bottom, i.e. the
+    item that would have consumed it when walking the items top to bottom. The item tops are
+    sorted once and every line is placed with a single bisect, keeping page_lines order
+    within each item.
+    """
+    context_lines = [[] for _ in combined_data]
+    if not combined_data:
+        return context_lines
+    tops = [get_top(item['bbox']) for item in combined_data]
+    for line in page_lines:
+        index = bisect_right(tops, get_bottom(line['bbox']))
+        if index < len(tops):
+            context_lines[index].append(line['content'].strip())
+    return context_lines
+
+class JoinedTexts:
+    """
+    A page's structured texts joined into one string, answering "is this line a substring of
+    any of the texts?" with a single str scan instead of a Python loop over the texts.
+
+    Each query still costs time linear in the total length of the texts (the scan runs in C);
+    what is saved is the per-text interpreter overhead and the duplicate and empty texts.
+    The texts are joined with a separator that cannot occur in a query, so a match can never
+    span two texts; queries containing the separator fall back to a per-text scan.
+    """
+    SEPARATOR = "\x00"
+
+    def __init__(self, texts):
+        self.texts = [text for text in dict.fromkeys(texts) if text]
+        self.joined = self.SEPARATOR.join(self.texts)
+
+    def __contains__(self, line):
+        if self.SEPARATOR in line:
+            return any(line in text for text in self.texts)
+        return line in self.joined
+
 ###############################
 # Combine Page Data Functions
 ###############################
 
-def combine_page_data(page_tables, page_kv_pairs, page_lines):
+def combine_page_data(page_tables, page_kv_pairs, page_lines, metrics=None):
     """
     Combine table and key–value pair data for a single page.
     
@@ -33,50 +210,49 @@ def combine_page_data(page_tables, page_kv_pairs, page_lines):
     For each structured data item (table or kv_pair), context lines ("k-lines")
     from page_lines (those lines whose bottom is above the item's top) are collected.
     Additionally, any context line whose text appears in any structured content is removed.
+    An optional StageMetrics records time spent per step and item counts; time not covered
+    by a named step (joining the structured texts, assembling the output) goes to "combine_other".
     """
-    # Filter out kv_pair items that lie completely inside any table's bbox.
-    filtered_kv = []
-    for kv in page_kv_pairs:
-        contained = False
-        for table in page_tables:
-            if is_within(kv['bbox'], table['bbox']):
-                contained = True
-                break
-        if not contained:
-            filtered_kv.append(kv)
+    metrics = metrics or NO_METRICS
+    metrics.count("pages")
+    metrics.count("tables", len(page_tables))
+    metrics.count("kv_pairs", len(page_kv_pairs))
+    metrics.count("lines", len(page_lines))
     
-    combined_data = page_tables + filtered_kv
-    combined_data.sort(key=lambda item: get_top(item['bbox']))
+    with metrics.stage("combine_other"):
+        # Filter out kv_pair items that lie completely inside any table's bbox.
+        with metrics.stage("containment"):
+            contained = find_contained_items(page_kv_pairs, page_tables)
+            filtered_kv = [kv for kv, inside in zip(page_kv_pairs, contained) if not inside]
+        metrics.count("kv_pairs_in_tables", len(page_kv_pairs) - len(filtered_kv))
     
-    # Collect structured texts so they can be excluded from k-lines.
-    structured_texts = [item.get("content", "").strip() for item in (page_tables + page_kv_pairs)]
+        with metrics.stage("k_line_assignment"):
+            combined_data = page_tables + filtered_kv
+            combined_data.sort(key=lambda item: get_top(item['bbox']))
+            assigned_lines = assign_k_lines(combined_data, page_lines)
     
-    remaining_lines = page_lines.copy()
-    final_output = []
-    for data in combined_data:
-        region_top = get_top(data['bbox'])
-        context_lines = []
-        new_remaining = []
-        for line in remaining_lines:
-            if get_bottom(line['bbox']) < region_top:
-                context_lines.append(line['content'].strip())
-            else:
-                new_remaining.append(line)
-        remaining_lines = new_remaining
-        # Remove any context line that appears in any structured text.
-        filtered_context = [
-            line for line in context_lines
-            if not any(line and (line in s) for s in structured_texts)
-        ]
-        final_output.append({
-            "page_no": data['page_no'],
-            "k-lines": "\n".join(filtered_context),
-            "type": data['type'],
-            "content": data['content'],
-            "bbox": data['bbox'],
+        # Join the structured texts so they can be excluded from k-lines.
+        structured_texts = JoinedTexts(item.get("content", "").strip() for item in (page_tables + page_kv_pairs))
+    
+        final_output = []
+        for data, context_lines in zip(combined_data, assigned_lines):
+            # Remove any context line that appears in any structured text.
+            with metrics.stage("k_line_filter"):
+                filtered_context = [
+                    line for line in context_lines
+                    if not (line and line in structured_texts)
+                ]
+            metrics.count("k_lines_kept", len(filtered_context))
+            metrics.count("k_lines_removed", len(context_lines) - len(filtered_context))
+            final_output.append({
+                "page_no": data['page_no'],
+                "k-lines": "\n".join(filtered_context),
+                "type": data['type'],
+                "content": data['content'],
+                "bbox": data['bbox'],
             
-        })
-    return final_output
+            })
+        return final_output
 
 ##############################
 # Standardize Input Functions
@@ -172,24 +348,63 @@ def standardize_line_item(page_item):
         })
     return standardized_lines
 
-def load_and_standardize_tables(file_path):
-    with open(file_path, 'r') as f:
-        data = json.load(f)
-    tables = data.get("tables", [])
-    return [standardize_table_item(item) for item in tables]
-
-def load_and_standardize_kv(file_path):
-    with open(file_path, 'r') as f:
-        data = json.load(f)
-    return [standardize_kv_item(item) for item in data]
-
-def load_and_standardize_lines(file_path):
-    with open(file_path, 'r') as f:
-        data = json.load(f)
-    standardized = []
-    for page_item in data:
-        standardized.extend(standardize_line_item(page_item))
-    return standardized
+def load_and_standardize_tables(file_path, metrics=None):
+    metrics = metrics or NO_METRICS
+    with metrics.stage("load_json"):
+        with open(file_path, 'r') as f:
+            data = json.load(f)
+    with metrics.stage("standardize"):
+        tables = data.get("tables", [])
+        return [standardize_table_item(item) for item in tables]
+
+def load_and_standardize_kv(file_path, metrics=None):
+    metrics = metrics or NO_METRICS
+    with metrics.stage("load_json"):
+        with open(file_path, 'r') as f:
+            data = json.load(f)
+    with metrics.stage("standardize"):
+        return [standardize_kv_item(item) for item in data]
+
+def load_and_standardize_lines(file_path, metrics=None):
+    metrics = metrics or NO_METRICS
+    with metrics.stage("load_json"):
+        with open(file_path, 'r') as f:
+            data = json.load(f)
+    with metrics.stage("standardize"):
+        standardized = []
+        for page_item in data:
+            standardized.extend(standardize_line_item(page_item))
+        return standardized
+
+def iter_standardized_line_pages(file_path, metrics=None):
+    """
+    Stream a lines JSON file with ijson and yield (page, standardized_lines) pairs,
+    so only one page item is held in memory at a time.
+    Consecutive page items for the same page are merged; items without a valid
+    page number are dropped, as in group_by_page.
+    """
+    if ijson is None:
+        raise ImportError("Streaming mode requires the ijson package (pip install ijson).")
+    metrics = metrics or NO_METRICS
+    end = object()
+    current_page, current_lines = None, []
+    with open(file_path, 'rb') as f:
+        page_items = ijson.items(f, "item", use_float=True)
+        while True:
+            with metrics.stage("load_json"):
+                page_item = next(page_items, end)
+            if page_item is end:
+                break
+            with metrics.stage("standardize"):
+                page_groups = group_by_page(standardize_line_item(page_item))
+            for page, lines in page_groups.items():
+                if page != current_page and current_lines:
+                    yield current_page, current_lines
+                    current_lines = []
+                current_page = page
+                current_lines.extend(lines)
+    if current_lines:
+        yield current_page, current_lines
 
 def group_by_page(items, page_field="page_no"):
     groups = {}
@@ -206,80 +421,468 @@ def group_by_page(items, page_field="page_no"):
 # Combine All JSON Files for a File
 ####################################
 
-def combine_all_json_files(table_file_path, kv_file_path, lines_file_path):
+def iter_page_inputs(tables_by_page, kv_by_page, line_pages):
     """
-    Load and standardize three JSON files (tables, key–value pairs, and lines),
-    group the items by page, and then combine the data on each page.
-    Returns a dictionary keyed by page number.
+    Yield (page, page_tables, page_kv, page_lines) in ascending page order.
+    line_pages is an iterable of (page, lines) in ascending page order, either from a fully
+    loaded lines file or streamed one page at a time; pages that only have tables or kv pairs
+    are slotted in between them.
+    """
+    structured_pages = sorted(set(tables_by_page.keys()) | set(kv_by_page.keys()))
+    next_structured = 0
+    last_page = None
+    for page, page_lines in line_pages:
+        if last_page is not None and page <= last_page:
+            raise ValueError(f"Lines for page {page} appear after page {last_page}; "
+                             "streaming requires page items in ascending page order.")
+        while next_structured < len(structured_pages) and structured_pages[next_structured] < page:
+            structured_page = structured_pages[next_structured]
+            next_structured += 1
+            yield (structured_page, tables_by_page.get(structured_page, []),
+                   kv_by_page.get(structured_page, []), [])
+        if next_structured < len(structured_pages) and structured_pages[next_structured] == page:
+            next_structured += 1
+        last_page = page
+        yield page, tables_by_page.get(page, []), kv_by_page.get(page, []), page_lines
+    for structured_page in structured_pages[next_structured:]:
+        yield structured_page, tables_by_page.get(structured_page, []), kv_by_page.get(structured_page, []), []
+
+def combine_page_task(job):
+    """
+    Worker entry point for page-level parallelism: job is (page_tables, page_kv, page_lines, instrument).
+    Returns (combined_items, counters), where counters is None unless instrument is set.
     """
-    standardized_tables = load_and_standardize_tables(table_file_path)
-    standardized_kv = load_and_standardize_kv(kv_file_path)
-    standardized_lines = load_and_standardize_lines(lines_file_path)
+    page_tables, page_kv, page_lines, instrument = job
+    metrics = StageMetrics() if instrument else None
+    combined_items = combine_page_data(page_tables, page_kv, page_lines, metrics)
+    return combined_items, (metrics.counters if metrics is not None else None)
+
+# Documents are only fanned out to page workers from this many pages on; shorter ones are
+# combined inline, where pickling each page to a worker would cost more than it saves.
+PAGE_WORKERS_MIN_PAGES = 64
+
+def iter_combined_pages(tables_by_page, kv_by_page, line_pages, metrics=None, page_executor=None, window=8,
+                        min_pages=PAGE_WORKERS_MIN_PAGES):
+    """
+    Yield (page, combined_items) in ascending page order (see iter_page_inputs).
+    
+    With a page_executor, the first min_pages pages are still combined inline; only the pages of
+    a longer document run combine_page_data on its workers, with at most window pages in
+    flight at once, so a streamed document still never has to be held in memory as a whole.
+    Results are yielded in page order as they complete. Worker-side stage times are not
+    collected; metrics get the worker counters plus the time spent waiting on workers.
+    """
+    page_inputs = iter_page_inputs(tables_by_page, kv_by_page, line_pages)
+    inline_pages = page_inputs if page_executor is None else islice(page_inputs, min_pages)
+    for page, page_tables, page_kv, page_lines in inline_pages:
+        yield page, combine_page_data(page_tables, page_kv, page_lines, metrics)
+    if page_executor is None:
+        return
     
-    tables_by_page = group_by_page(standardized_tables)
-    kv_by_page = group_by_page(standardized_kv)
-    lines_by_page = group_by_page(standardized_lines)
+    instrument = isinstance(metrics, StageMetrics)
+    metrics = metrics or NO_METRICS
     
-    all_pages = set(tables_by_page.keys()) | set(kv_by_page.keys()) | set(lines_by_page.keys())
-    all_pages = sorted(all_pages)
+    def collect(page, future):
+        with metrics.stage("page_workers_wait"):
+            combined_items, counters = future.result()
+        for name, value in (counters or {}).items():
+            metrics.count(name, value)
+        return page, combined_items
     
-    combined_results = {}
-    for page in all_pages:
-        page_tables = tables_by_page.get(page, [])
-        page_kv = kv_by_page.get(page, [])
-        page_lines = lines_by_page.get(page, [])
-        combined_results[page] = combine_page_data(page_tables, page_kv, page_lines)
-    return combined_results
+    pending = deque()
+    for page, page_tables, page_kv, page_lines in page_inputs:
+        pending.append((page, page_executor.submit(combine_page_task, (page_tables, page_kv, page_lines, instrument))))
+        if len(pending) >= window:
+            yield collect(*pending.popleft())
+    while pending:
+        yield collect(*pending.popleft())
+
+def iter_combine_json_files(table_file_path, kv_file_path, lines_file_path, streaming=False, metrics=None,
+                            page_workers=None, page_executor=None):
+    """
+    Generator version of combine_all_json_files that yields (page, combined_items) one page at a time.
+    With streaming=True the lines file, usually by far the largest input, is parsed incrementally,
+    so memory is bounded by the tables, the kv pairs and a single page of lines.
+    With page_workers set, the pages of a document longer than PAGE_WORKERS_MIN_PAGES are
+    combined on a pool of that many processes and reassembled in page order, so one very long
+    document can use more than one core. page_executor reuses a process pool shared across
+    documents instead of starting one here (its processes only start once a page is submitted).
+    """
+    metrics = metrics or NO_METRICS
+    tables = load_and_standardize_tables(table_file_path, metrics)
+    kv_pairs = load_and_standardize_kv(kv_file_path, metrics)
+    with metrics.stage("group_by_page"):
+        tables_by_page = group_by_page(tables)
+        kv_by_page = group_by_page(kv_pairs)
+    if streaming:
+        line_pages = iter_standardized_line_pages(lines_file_path, metrics)
+    else:
+        lines = load_and_standardize_lines(lines_file_path, metrics)
+        with metrics.stage("group_by_page"):
+            line_pages = sorted(group_by_page(lines).items())
+    if not page_workers:
+        yield from iter_combined_pages(tables_by_page, kv_by_page, line_pages, metrics)
+        return
+    if page_executor is not None:
+        yield from iter_combined_pages(tables_by_page, kv_by_page, line_pages, metrics,
+                                       page_executor=page_executor, window=2 * page_workers)
+        return
+    with ProcessPoolExecutor(max_workers=page_workers) as page_executor:
+        yield from iter_combined_pages(tables_by_page, kv_by_page, line_pages, metrics,
+                                       page_executor=page_executor, window=2 * page_workers)
+
+def combine_all_json_files(table_file_path, kv_file_path, lines_file_path, streaming=False, metrics=None,
+                           page_workers=None):
+    """
+    Load and standardize three JSON files (tables, key–value pairs, and lines),
+    group the items by page, and then combine the data on each page.
+    With streaming=True the lines file is read one page at a time (see iter_combine_json_files).
+    An optional StageMetrics records per-stage time and item counts.
+    page_workers fans the pages out across a process pool (see iter_combine_json_files).
+    Returns a dictionary keyed by page number.
+    """
+    return dict(iter_combine_json_files(table_file_path, kv_file_path, lines_file_path, streaming, metrics,
+                                        page_workers))
+
+###################################
+# Output Writers
+###################################
+
+OUTPUT_FILENAMES = {
+    "json": "combined_structured_data.json",
+    "jsonl": "combined_structured_data.jsonl"
+}
+
+def encode_json(obj, compact=False):
+    """
+    Serialize obj to UTF-8 bytes.
+    compact=True drops all whitespace and uses orjson when it is installed;
+    otherwise the output matches json.dump(obj, indent=4).
+    """
+    if not compact:
+        return json.dumps(obj, indent=4).encode()
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":")).encode()
+
+def write_combined_json(pages, output_path, compact=False):
+    """
+    Write (page, combined_items) pairs as one JSON object keyed by page number,
+    emitting each page as soon as it arrives instead of building the whole dict first.
+    With compact=False the bytes are identical to json.dump(dict(pages), f, indent=4).
+    """
+    indent = b"" if compact else b"    "
+    with open(output_path, "wb") as f:
+        f.write(b"{")
+        first = True
+        for page, items in pages:
+            f.write(b"" if first else b",")
+            if not compact:
+                f.write(b"\n")
+            # JSON strings never contain raw newlines, so re-indenting line by line is safe.
+            value = encode_json(items, compact).replace(b"\n", b"\n" + indent)
+            f.write(indent + json.dumps(str(page)).encode() + (b":" if compact else b": ") + value)
+            first = False
+        if not first and not compact:
+            f.write(b"\n")
+        f.write(b"}")
+
+def write_combined_jsonl(pages, output_path, compact=True):
+    """
+    Write one line per page, {"page_no": page, "items": [...]}, as each page arrives.
+    compact=False keeps the json module's default ", " and ": " separators.
+    """
+    with open(output_path, "wb") as f:
+        for page, items in pages:
+            record = {"page_no": page, "items": items}
+            f.write((encode_json(record, compact=True) if compact else json.dumps(record).encode()) + b"\n")
 
 ###################################
 # Multi-File Processing Functions
 ###################################
 
-def process_single_file(sub_dir, file, table_dir, kv_pair_dir, lines_dir, output_extraction_dir):
+# Bump whenever a change to the combine stage alters combined_structured_data.json,
+# so incremental runs regenerate outputs written by older code.
+COMBINE_CODE_VERSION = "2"
+
+def file_sha256(path):
+    """Return the hex SHA-256 digest of a file, read in 1 MiB blocks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def sidecar_path_for(output_path, kind):
+    """Return the path of a sidecar file (e.g. "manifest" or "metrics") stored next to a combined output file."""
+    return os.path.splitext(output_path)[0] + f".{kind}.json"
+
+def manifest_path_for(output_path):
+    """Return the path of the manifest stored next to a combined output file."""
+    return sidecar_path_for(output_path, "manifest")
+
+def build_manifest(input_paths):
+    """Record the code version plus size, mtime and content hash of each input file."""
+    inputs = {}
+    for name, path in input_paths.items():
+        stat = os.stat(path)
+        inputs[name] = {
+            "path": path,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "sha256": file_sha256(path)
+        }
+    return {"code_version": COMBINE_CODE_VERSION, "inputs": inputs}
+
+def check_manifest(manifest, input_paths):
+    """
+    Return (current, refreshed) for a manifest loaded from disk or from a result store.
+    current is True if the manifest was produced by this code version from the current inputs.
+    
+    Inputs whose size and mtime match the manifest are trusted without being read, so an
+    unchanged file costs three stats. Inputs that were touched but not modified are confirmed
+    by hash and their new mtime is written into manifest, with refreshed=True telling the
+    caller to save it so the next run takes the fast path again.
+    """
+    if not manifest or manifest.get("code_version") != COMBINE_CODE_VERSION:
+        return False, False
+    recorded_inputs = manifest.get("inputs", {})
+    if set(recorded_inputs) != set(input_paths):
+        return False, False
+    
+    refreshed = False
+    for name, path in input_paths.items():
+        recorded = recorded_inputs[name]
+        stat = os.stat(path)
+        if stat.st_size != recorded.get("size"):
+            return False, False
+        if stat.st_mtime_ns != recorded.get("mtime_ns"):
+            if file_sha256(path) != recorded.get("sha256"):
+                return False, False
+            recorded["mtime_ns"] = stat.st_mtime_ns
+            refreshed = True
+    return True, refreshed
+
+def is_output_current(output_path, input_paths):
+    """Return True if output_path and its manifest show that none of the inputs changed (see check_manifest)."""
+    manifest_path = manifest_path_for(output_path)
+    if not os.path.exists(output_path) or not os.path.exists(manifest_path):
+        return False
+    try:
+        with open(manifest_path, "r") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return False
+    current, refreshed = check_manifest(manifest, input_paths)
+    if refreshed:
+        with open(manifest_path, "w") as f:
+            json.dump(manifest, f, indent=4)
+    return current
+
+def is_stored_document_current(conn, doc_key, input_paths):
+    """Result store counterpart of is_output_current, using the manifest saved with the document."""
+    manifest = result_store.get_document_manifest(conn, result_store.COMBINED_STAGE, doc_key)
+    current, refreshed = check_manifest(manifest, input_paths)
+    if refreshed:
+        result_store.set_document_manifest(conn, result_store.COMBINED_STAGE, doc_key, manifest)
+    return current
+
+def metrics_record_for(sub_dir, file, start, metrics):
+    """Return the per-document metrics record of a file whose processing began at perf_counter() start."""
+    metrics_record = {"file": os.path.join(sub_dir, file), "wall_seconds": time.perf_counter() - start}
+    metrics_record.update(metrics.to_dict())
+    return metrics_record
+
+def process_single_file(sub_dir, file, table_dir, kv_pair_dir, lines_dir, output_extraction_dir,
+                        incremental=False, streaming=False, output_format="json", compact=False,
+                        metrics=None, result_store_path=None, page_workers=None, page_executor=None):
     """
     Process a single file.
     Constructs full paths for the table, kv_pair, and lines JSON files based on sub_dir and file name.
-    Calls combine_all_json_files to generate the combined structured data, and saves the output.
+    Combines the structured data page by page, writes each page out as soon as it is combined,
+    and saves a manifest of the inputs next to the output.
+    With incremental=True the file is skipped when the manifest shows that none of the inputs
+    (nor the combine code version) changed since the output was written.
+    With streaming=True the lines file is parsed one page at a time.
+    output_format is "json" (one object keyed by page) or "jsonl" (one line per page);
+    compact=True writes without indentation, using orjson when available.
+    If a StageMetrics is passed, per-stage times and counts are recorded into it and saved
+    to a combined_structured_data.metrics.json sidecar (or, in the result store, with the
+    document; see result_store.get_document_metrics).
+    With result_store_path set, the pages (and the manifest) go to that SQLite result store
+    instead of a per-document directory; output_format and compact are then ignored.
+    page_workers combines the pages of a long document on a process pool of that size, the
+    shared page_executor if one is given (see iter_combine_json_files).
+    Returns True if the output was written and False if it was skipped.
     """
+    if output_format not in OUTPUT_FILENAMES:
+        raise ValueError(f"Unknown output_format: {output_format!r}")
     full_table_path = os.path.join(table_dir, sub_dir, file)
     full_kv_path = os.path.join(kv_pair_dir, sub_dir, file)
     full_lines_path = os.path.join(lines_dir, sub_dir, file)
-    print(f"Processing: {full_table_path}, {full_kv_path}, {full_lines_path}")
-    
-    combined_data = combine_all_json_files(full_table_path, full_kv_path, full_lines_path)
+    input_paths = {"tables": full_table_path, "kv_pairs": full_kv_path, "lines": full_lines_path}
     
     # Use the base filename to create a subdirectory for output
     base_filename = os.path.splitext(file)[0]
     output_subdir = os.path.join(output_extraction_dir, sub_dir, base_filename)
+    output_path = os.path.join(output_subdir, OUTPUT_FILENAMES[output_format])
+    if result_store_path:
+        store = result_store.get_result_store(result_store_path)
+        doc_key = result_store.document_key(sub_dir, file)
+        is_current = lambda: is_stored_document_current(store, doc_key, input_paths)
+    else:
+        is_current = lambda: is_output_current(output_path, input_paths)
+    if incremental and is_current():
+        print(f"Skipping unchanged file: {full_table_path}")
+        return False
+    print(f"Processing: {full_table_path}, {full_kv_path}, {full_lines_path}")
+    start = time.perf_counter()
+    
+    # Take the manifest before reading, so an input modified mid-run is picked up next time.
+    with (metrics or NO_METRICS).stage("manifest"):
+        manifest = build_manifest(input_paths)
+    pages = iter_combine_json_files(full_table_path, full_kv_path, full_lines_path, streaming, metrics,
+                                    page_workers, page_executor)
+    
+    if result_store_path:
+        with (metrics or NO_METRICS).stage("write"):
+            result_store.write_combined_document(store, doc_key, pages, manifest)
+        if metrics is not None:
+            result_store.set_document_metrics(store, result_store.COMBINED_STAGE, doc_key,
+                                              metrics_record_for(sub_dir, file, start, metrics))
+        print(f"Processed file. Output saved to {result_store_path} as {doc_key}")
+        return True
+    
+    # Write to a temporary file so a crash never leaves a truncated output behind a valid manifest.
+    # Pages are combined lazily while writing; their stages are not charged to "write".
     os.makedirs(output_subdir, exist_ok=True)
+    partial_path = output_path + ".partial"
+    with (metrics or NO_METRICS).stage("write"):
+        if output_format == "jsonl":
+            write_combined_jsonl(pages, partial_path, compact)
+        else:
+            write_combined_json(pages, partial_path, compact)
+        os.replace(partial_path, output_path)
+        with open(manifest_path_for(output_path), "w") as f:
+            json.dump(manifest, f, indent=4)
     
-    output_path = os.path.join(output_subdir, "combined_structured_data.json")
-    with open(output_path, "w") as outfile:
-        json.dump(combined_data, outfile, indent=4)
+    if metrics is not None:
+        with open(sidecar_path_for(output_path, "metrics"), "w") as f:
+            json.dump(metrics_record_for(sub_dir, file, start, metrics), f, indent=4)
     
     print(f"Processed file. Output saved to {output_path}")
+    return True
+
+def available_cpu_count():
+    """Return the number of CPUs this process may run on (respecting affinity where supported)."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def iter_json_files(table_dir):
+    """Yield (sub_dir, file) for every JSON file under table_dir."""
+    for root, _, files in os.walk(table_dir):
+        sub_dir = os.path.relpath(root, table_dir)
+        for file in files:
+            if file.endswith('.json'):
+                yield sub_dir, file
 
-def process_structured_extraction_directories(table_dir, kv_pair_dir, lines_dir, output_extraction_dir):
+def run_file_task(task):
+    """
+    Worker entry point for one file.
+    task is (args, options, instrument): the positional path arguments and keyword flags of
+    process_single_file (so it is cheap to send to a worker process) and whether to collect
+    metrics. Returns a result dict instead of raising so failures can be summarized;
+    instrumented runs include the file's metrics.
+    """
+    args, options, instrument = task
+    sub_dir, file = args[0], args[1]
+    metrics = StageMetrics() if instrument else None
+    try:
+        written = process_single_file(*args, metrics=metrics, **options)
+        result = {"file": os.path.join(sub_dir, file), "status": "ok" if written else "skipped"}
+        if metrics is not None and written:
+            result["metrics"] = metrics.to_dict()
+        return result
+    except Exception as e:
+        return {
+            "file": os.path.join(sub_dir, file),
+            "status": "error",
+            "error": f"{type(e).__name__}: {e}",
+            "traceback": traceback.format_exc()
+        }
+
+def process_structured_extraction_directories(table_dir, kv_pair_dir, lines_dir, output_extraction_dir,
+                                              executor_type="thread", max_workers=None, chunksize=16,
+                                              incremental=False, streaming=False, output_format="json",
+                                              compact=False, instrument=False, result_store_path=None,
+                                              page_workers=None):
     """
     Walk through the table_dir (assuming the same file structure exists in kv_pair_dir and lines_dir),
     and process each JSON file concurrently.
+    
+    executor_type is "thread" (4 workers by default) or "process" (one worker per available CPU by
+    default, since the combine stage is GIL-bound). In process mode tasks are handed to the workers
+    in batches of chunksize files.
+    With incremental=True, files whose inputs are unchanged since their last run are skipped.
+    With streaming=True, lines files are parsed incrementally instead of loaded whole.
+    output_format and compact select the writer (see process_single_file).
+    With instrument=True every processed file gets a metrics sidecar, and the per-stage totals
+    across the run are added to the summary and saved as combine_metrics_summary.json in
+    output_extraction_dir.
+    With result_store_path set, outputs go to that single SQLite file instead of one directory
+    per document (see process_single_file).
+    page_workers additionally splits the pages of each document longer than PAGE_WORKERS_MIN_PAGES
+    across one process pool of that size, shared by the whole run, which keeps one very long
+    document from dominating the tail of a thread-mode run. It cannot be combined with
+    executor_type="process": every file worker would then need its own pool, up to
+    cpu_count * page_workers processes in all.
+    Returns a summary dict with the file counts and one entry per failed file.
     """
-    tasks = []
-    with ThreadPoolExecutor(max_workers=4) as executor:
-        for root, _, files in os.walk(table_dir):
-            sub_dir = os.path.relpath(root, table_dir)
-            for file in files:
-                if file.endswith('.json'):
-                    tasks.append(
-                        executor.submit(
-                            process_single_file, sub_dir, file, table_dir, kv_pair_dir, lines_dir, output_extraction_dir
-                        )
-                    )
-        for future in as_completed(tasks):
-            try:
-                future.result()
-            except Exception as e:
-                print("Error processing file:", e)
+    if page_workers and executor_type == "process":
+        raise ValueError("page_workers only works with executor_type=\"thread\"; "
+                         "process mode already uses every CPU for whole files.")
+    page_executor = ProcessPoolExecutor(max_workers=page_workers) if page_workers else None
+    options = {
+        "incremental": incremental,
+        "streaming": streaming,
+        "output_format": output_format,
+        "compact": compact,
+        "result_store_path": result_store_path,
+        "page_workers": page_workers,
+        "page_executor": page_executor
+    }
+    tasks = [
+        ((sub_dir, file, table_dir, kv_pair_dir, lines_dir, output_extraction_dir), options, instrument)
+        for sub_dir, file in iter_json_files(table_dir)
+    ]
+    if executor_type == "process":
+        executor = ProcessPoolExecutor(max_workers=max_workers or available_cpu_count())
+    elif executor_type == "thread":
+        executor = ThreadPoolExecutor(max_workers=max_workers or 4)
+    else:
+        raise ValueError(f"Unknown executor_type: {executor_type!r}")
+    
+    summary = {"total_files": len(tasks), "succeeded": 0, "skipped": 0, "failed": 0, "failures": []}
+    file_metrics = []
+    with executor, (page_executor or nullcontext()):
+        for result in executor.map(run_file_task, tasks, chunksize=chunksize):
+            if result["status"] == "ok":
+                summary["succeeded"] += 1
+                if "metrics" in result:
+                    file_metrics.append(result["metrics"])
+            elif result["status"] == "skipped":
+                summary["skipped"] += 1
+            else:
+                summary["failed"] += 1
+                summary["failures"].append(result)
+    if instrument:
+        summary["metrics"] = aggregate_metrics(file_metrics)
+        os.makedirs(output_extraction_dir, exist_ok=True)
+        with open(os.path.join(output_extraction_dir, "combine_metrics_summary.json"), "w") as f:
+            json.dump(summary["metrics"], f, indent=4)
+    return summary
 
 ###################################
 # Main Entry Point
@@ -291,7 +894,13 @@ if __name__ == "__main__":
     document_intelligence_lines_dir = "../tst/document_intelligence_lines"
     output_extraction_dir = "../tst/pipeline_results_v2"
     
-    process_structured_extraction_directories(document_intelligence_tables_dir,
-                                              document_intelligence_kv_pairs_dir,
-                                              document_intelligence_lines_dir,
-                                              output_extraction_dir)
+    summary = process_structured_extraction_directories(document_intelligence_tables_dir,
+                                                        document_intelligence_kv_pairs_dir,
+                                                        document_intelligence_lines_dir,
+                                                        output_extraction_dir,
+                                                        executor_type="process",
+                                                        incremental=True)
+    print(f"Processed {summary['succeeded']} of {summary['total_files']} files, "
+          f"{summary['skipped']} unchanged, {summary['failed']} failed.")
+    for failure in summary["failures"]:
+        print(f"  {failure['file']}: {failure['error']}")